@@ -2,26 +2,21 @@ from lib import mr
 from lib import operations
 
 
-def build_word_count_graph(input_stream, text_column='text', count_column='count'):
+def build_word_count_graph(input_stream, text_column='text', count_column='count', schema=None):
     return mr.FireMR()\
-        .read_from_iter(input_stream)\
-        .map(operations.FilterPunctuation(text_column))\
-        .map(operations.LowerCase(text_column))\
-        .map(operations.Split(text_column))\
-        .sort([text_column])\
-        .aggregate(operations.Count(count_column), [text_column])\
+        .read_from_iter(input_stream, schema)\
+        .map(operations.Tokenize(text_column, []))\
+        .aggregate(operations.Count(count_column), [text_column], strategy='hash')\
         .sort([count_column, text_column])
 
 
 
-def build_inverted_index_graph(input_stream, doc_column='doc_id', text_column='text'):
+def build_inverted_index_graph(input_stream, doc_column='doc_id', text_column='text', cache=None, schema=None):
     read_stream = mr.FireMR() \
-        .read_from_iter(input_stream)
+        .read_from_iter(input_stream, schema)
 
     split_by_words = read_stream \
-        .map(operations.FilterPunctuation(text_column)) \
-        .map(operations.LowerCase(text_column)) \
-        .map(operations.Split(text_column))
+        .map(operations.Tokenize(text_column, [doc_column]))
 
     count_docs = read_stream \
         .aggregate(operations.Count('total_doc_count'), [])
@@ -30,10 +25,13 @@ def build_inverted_index_graph(input_stream, doc_column='doc_id', text_column='t
         .reduce(operations.FirstReducer(), [doc_column, text_column]) \
         .sort([text_column]) \
         .aggregate(operations.Count('doc_with_word_count'), [text_column]) \
-        .join(operations.InnerJoiner(), count_docs, []) \
+        .join(operations.InnerJoiner(), count_docs, [], strategy='broadcast') \
         .map(operations.Idf('doc_with_word_count', 'total_doc_count')) \
         .sort([text_column])
 
+    if cache is not None:
+        idf = idf.cache(cache)
+
     tf = split_by_words.sort([doc_column]) \
         .reduce(operations.Tf(text_column), [doc_column]) \
         .sort([text_column])
@@ -41,21 +39,19 @@ def build_inverted_index_graph(input_stream, doc_column='doc_id', text_column='t
     tf_idf_result = tf.join(operations.InnerJoiner(), idf, [text_column]) \
         .map(operations.Product('tf', 'idf', column_result='tf_idf'))
 
-    top3 = tf_idf_result.sort([text_column]) \
-        .reduce(operations.Max('tf_idf', 3), [text_column]) \
+    top3 = tf_idf_result \
+        .top_k('tf_idf', 3, [text_column]) \
         .map(operations.Cut([text_column, doc_column, 'tf_idf']))
 
     return top3
 
 
-def build_pmi_graph(input_stream, doc_column='doc_id', text_column='text'):
+def build_pmi_graph(input_stream, doc_column='doc_id', text_column='text', schema=None):
     read_stream = mr.FireMR() \
-        .read_from_iter(input_stream)
+        .read_from_iter(input_stream, schema)
 
     split_by_words = read_stream \
-        .map(operations.FilterPunctuation(text_column)) \
-        .map(operations.LowerCase(text_column)) \
-        .map(operations.Split(text_column)) \
+        .map(operations.Tokenize(text_column, [doc_column])) \
         .sort([doc_column, text_column])
 
     count_words_in_doc = split_by_words.sort([doc_column, text_column]) \
@@ -75,41 +71,30 @@ def build_pmi_graph(input_stream, doc_column='doc_id', text_column='text'):
 
     result = tf.join(operations.OuterJoiner(), total_tf, [text_column]) \
         .map(operations.Idf('total_tf', 'tf', 'pmi'))\
-        .sort([doc_column]) \
-        .reduce(operations.Max('pmi', 10), [doc_column]) \
+        .top_k('pmi', 10, [doc_column]) \
         .map(operations.Cut([text_column, doc_column, 'pmi']))
 
     return result
 
 
-def build_yandex_maps_graph(input_stream_time, input_stream_length):
+def build_yandex_maps_graph(input_stream_time, input_stream_length, schema=None):
     read_time_stream = mr.FireMR() \
-        .read_from_iter(input_stream_time) \
-        .map(operations.WeekHourSplit('enter_time', 'leave_time')) \
-        .sort(['edge_id'])
+        .read_from_iter(input_stream_time, schema) \
+        .map(operations.WeekHourSplit('enter_time', 'leave_time'))
 
     read_length_stream = mr.FireMR() \
-        .read_from_iter(input_stream_length) \
-        .map(operations.DistanceFromLonLat('start', 'end')) \
-        .sort(['edge_id'])
+        .read_from_iter(input_stream_length, schema) \
+        .map(operations.DistanceFromLonLat('start', 'end'))
 
     agg = read_time_stream \
-        .join(operations.InnerJoiner(), read_length_stream, ['edge_id']) \
+        .join(operations.InnerJoiner(), read_length_stream, ['edge_id'], strategy='hash') \
         .map(operations.Product('length', 'hour_time', column_result='hour_length')) \
         .map(operations.Divide('hour_length', 'total_time', column_result='hour_length')) \
         .map(operations.Cut(['weekday', 'hour', 'hour_length', 'hour_time'])) \
         .sort(['weekday', 'hour'])
 
-    length_agg = agg \
-        .aggregate(operations.Sum('hour_length'), keys=['weekday', 'hour']) \
-        .sort(['weekday', 'hour'])
-
-    time_agg = agg \
-        .aggregate(operations.Sum('hour_time'), keys=['weekday', 'hour']) \
-        .sort(['weekday', 'hour'])
-
-    result = length_agg \
-        .join(operations.InnerJoiner(), time_agg, ['weekday', 'hour']) \
+    result = agg \
+        .aggregate([operations.Sum('hour_length'), operations.Sum('hour_time')], keys=['weekday', 'hour']) \
         .map(operations.Velocity('hour_length', 'hour_time')) \
         .map(operations.Cut(['weekday', 'hour', 'speed']))
 
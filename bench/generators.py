@@ -0,0 +1,61 @@
+from datetime import datetime, timedelta
+from itertools import accumulate
+
+import json
+import os
+import random
+
+GRAPH_DATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'resource', 'graph_data.txt')
+VOCABULARY_SIZE = 50000
+WEEK_START = datetime(2017, 10, 9)
+TIME_FORMAT = '%Y%m%dT%H%M%S.%f'
+
+
+def vocabulary(size, seed):
+    rand = random.Random(seed)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rand.choice(letters) for _ in range(rand.randint(2, 10))))
+    return sorted(words)
+
+
+def texts(n, seed=0, words_per_doc=(5, 30)):
+    """
+    Documents {'doc_id', 'text'} of Zipf distributed words with some
+    capitalization and punctuation
+    """
+    words = vocabulary(VOCABULARY_SIZE, seed)
+    weights = list(accumulate(1 / (rank + 1) for rank in range(len(words))))
+    return _texts(n, random.Random(seed), words, weights, words_per_doc)
+
+
+def _texts(n, rand, words, weights, words_per_doc):
+    punctuation = ['', '', '', ',', '.', '!', '?', '...']
+    for doc_id in range(n):
+        text = []
+        for word in rand.choices(words, cum_weights=weights, k=rand.randint(*words_per_doc)):
+            if rand.random() < 0.1:
+                word = word.capitalize()
+            text.append(word + rand.choice(punctuation))
+        yield {'doc_id': doc_id, 'text': ' '.join(text)}
+
+
+def edges(filename=GRAPH_DATA):
+    """
+    Road graph edges {'start', 'end', 'edge_id'} of the reference data
+    """
+    with open(filename) as f:
+        return [json.loads(line) for line in f]
+
+
+def travel_times(n, edge_ids, seed=0):
+    """
+    Rides {'enter_time', 'leave_time', 'edge_id'} over given edges during one week
+    """
+    rand = random.Random(seed)
+    for _ in range(n):
+        enter = WEEK_START + timedelta(seconds=rand.uniform(0, 7 * 24 * 3600))
+        leave = enter + timedelta(seconds=rand.uniform(1, 120))
+        yield {'enter_time': enter.strftime(TIME_FORMAT), 'leave_time': leave.strftime(TIME_FORMAT),
+               'edge_id': rand.choice(edge_ids)}
@@ -0,0 +1,180 @@
+"""
+Benchmarks of the reference algorithms on deterministic synthetic data.
+
+    python -m bench.run --sizes 1000 100000 --baseline bench/baseline.json
+
+Every benchmark runs in its own process, so peak RSS is its own. Inputs are
+generated into lists before the timer starts, so timings are of the graph only.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+
+import algorithms
+from bench import generators
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+SIZES = [10 ** 3, 10 ** 4, 10 ** 5]
+TOLERANCE = 0.25
+
+
+def word_count(size, seed):
+    return algorithms.build_word_count_graph('texts'), {'texts': generators.texts(size, seed)}
+
+
+def inverted_index(size, seed):
+    return algorithms.build_inverted_index_graph('texts'), {'texts': generators.texts(size, seed)}
+
+
+def pmi(size, seed):
+    return algorithms.build_pmi_graph('texts'), {'texts': generators.texts(size, seed)}
+
+
+def yandex_maps(size, seed):
+    edges = generators.edges()
+    times = generators.travel_times(size, [e['edge_id'] for e in edges], seed)
+    return algorithms.build_yandex_maps_graph('times', 'lengths'), {'times': times, 'lengths': edges}
+
+
+BENCHMARKS = {
+    'word_count': word_count,
+    'inverted_index': inverted_index,
+    'pmi': pmi,
+    'yandex_maps': yandex_maps,
+}
+
+
+def peak_rss():
+    """
+    Peak resident set size of this process in bytes
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def generate(name, size, seed):
+    """
+    Graph of benchmark and its inputs read into lists
+    """
+    graph, inputs = BENCHMARKS[name](size, seed)
+    return graph, {k: list(records) for k, records in inputs.items()}
+
+
+def run_benchmark(name, size, seed=0, profile=True):
+    """
+    Run benchmark on size input rows, return its report. Stage timings come
+    from a separate profiled run, so that profiling doesn't slow the timed one.
+    """
+    graph, inputs = generate(name, size, seed)
+    start = perf_counter()
+    result = graph.run(verbose=False, **inputs)
+    seconds = perf_counter() - start
+
+    report = {
+        'benchmark': name,
+        'size': size,
+        'seconds': seconds,
+        'rows_per_second': size / seconds,
+        'output_rows': len(result),
+        'peak_rss': peak_rss(),
+    }
+    if profile:
+        graph, inputs = generate(name, size, seed)
+        _, stats = graph.run(verbose=False, profile=True, **inputs)
+        report['stages'] = [{'name': node.name, 'operations': node.operations, 'self_time': node.self_time,
+                             'user_time': node.user_time, 'records_in': node.records_in,
+                             'records_out': node.records_out} for node in stats.nodes]
+    return report
+
+
+def run_isolated(name, size, seed=0, profile=True):
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(1, mp_context=context) as pool:
+        return pool.submit(run_benchmark, name, size, seed, profile).result()
+
+
+def report_key(report):
+    return "{}:{}".format(report['benchmark'], report['size'])
+
+
+def compare(reports, baseline, tolerance=TOLERANCE):
+    """
+    Regressions of reports against baseline reports: throughput lower or peak
+    RSS higher than baseline by more than tolerance
+    """
+    regressions = []
+    for report in reports:
+        base = baseline.get(report_key(report))
+        if base is None:
+            continue
+        if report['rows_per_second'] < base['rows_per_second'] * (1 - tolerance):
+            regressions.append("{}: {:.0f} rows/s, baseline {:.0f} rows/s".format(
+                report_key(report), report['rows_per_second'], base['rows_per_second']))
+        if report['peak_rss'] > base['peak_rss'] * (1 + tolerance):
+            regressions.append("{}: peak RSS {} bytes, baseline {} bytes".format(
+                report_key(report), report['peak_rss'], base['peak_rss']))
+    return regressions
+
+
+def describe(report):
+    lines = ["{:<16}{:>10} rows {:>8.3f}s {:>10.0f} rows/s {:>8.1f} MiB".format(
+        report['benchmark'], report['size'], report['seconds'], report['rows_per_second'],
+        report['peak_rss'] / 2 ** 20)]
+    for stage in report.get('stages', []):
+        lines.append("    {:<14}{:>8.3f}s self {:>8.3f}s user {:>10} -> {:<10} {}".format(
+            stage['name'], stage['self_time'], stage['user_time'], stage['records_in'], stage['records_out'],
+            ", ".join(stage['operations'])))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the reference algorithms")
+    parser.add_argument('--benchmarks', nargs='+', choices=sorted(BENCHMARKS), default=sorted(BENCHMARKS))
+    parser.add_argument('--sizes', nargs='+', type=int, default=SIZES)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-profile', dest='profile', action='store_false', help="skip per stage timings")
+    parser.add_argument('--baseline', default=BASELINE, help="baseline to compare with")
+    parser.add_argument('--save-baseline', action='store_true', help="store reports as the new baseline")
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    parser.add_argument('--output', help="write reports as JSON to this file")
+    args = parser.parse_args(argv)
+
+    reports = []
+    for name in args.benchmarks:
+        for size in args.sizes:
+            report = run_isolated(name, size, args.seed, args.profile)
+            print(describe(report), flush=True)
+            reports.append(report)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(reports, f, indent=2)
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        for report in reports:
+            baseline[report_key(report)] = {k: report[k] for k in ('seconds', 'rows_per_second', 'peak_rss')}
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        return 0
+
+    if not os.path.exists(args.baseline):
+        return 0
+    with open(args.baseline) as f:
+        regressions = compare(reports, json.load(f), args.tolerance)
+    for regression in regressions:
+        print("Regression: {}".format(regression))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
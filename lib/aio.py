@@ -0,0 +1,114 @@
+from collections import deque
+
+import asyncio
+import contextvars
+import threading
+
+AIO_QUEUE_SIZE = 4096
+AIO_BLOCK_SIZE = 256
+RUNNING_LOOP = contextvars.ContextVar('running_loop', default=None)
+
+
+class AsyncSource:
+    """
+    Bridge from an async iterable consumed on the event loop to a blocking
+    iterator read by a worker thread. At most queue_size records are waiting
+    for the reader, the async iterable isn't consumed further until it reads.
+    """
+    def __init__(self, records, loop, queue_size=AIO_QUEUE_SIZE):
+        self.records = records
+        self.loop = loop
+        self.slots = asyncio.Semaphore(queue_size)
+        self.condition = threading.Condition()
+        self.buffer = deque()
+        self.done = False
+        self.error = None
+
+    async def pump(self):
+        try:
+            async for r in self.records:
+                await self.slots.acquire()
+                with self.condition:
+                    self.buffer.append(r)
+                    self.condition.notify()
+        except Exception as e:
+            self.error = e
+        finally:
+            with self.condition:
+                self.done = True
+                self.condition.notify()
+
+    def release(self, count):
+        for _ in range(count):
+            self.slots.release()
+
+    def __iter__(self):
+        while True:
+            with self.condition:
+                while not self.buffer and not self.done:
+                    self.condition.wait()
+                block = list(self.buffer)
+                self.buffer.clear()
+
+            if not block:
+                if self.error is not None:
+                    raise self.error
+                return
+            self.loop.call_soon_threadsafe(self.release, len(block))
+            for r in block:
+                yield r
+
+
+class AsyncSink:
+    """
+    Bridge from a worker thread to an async sink awaited on the event loop
+    for every record in order. Records are passed in blocks of block_size,
+    at most queue_size records are waiting for the sink, the writing thread
+    blocks until it accepts them.
+    """
+    def __init__(self, put, loop, queue_size=AIO_QUEUE_SIZE, block_size=AIO_BLOCK_SIZE):
+        self.put = put
+        self.loop = loop
+        self.block_size = block_size
+        self.slots = threading.Semaphore(max(1, queue_size // block_size))
+        self.queue = asyncio.Queue()
+        self.block = []
+        self.error = None
+        self.drained = asyncio.run_coroutine_threadsafe(self.drain(), loop)
+
+    async def drain(self):
+        try:
+            while True:
+                block = await self.queue.get()
+                if block is None:
+                    return
+                for r in block:
+                    await self.put(r)
+                self.slots.release()
+        except BaseException as e:
+            self.error = e
+            self.slots.release()
+            raise
+
+    def flush(self, block):
+        if self.error is None:
+            self.slots.acquire()
+        if self.error is not None:
+            self.drained.result()
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, block)
+
+    def send(self, r):
+        self.block.append(r)
+        if len(self.block) >= self.block_size:
+            self.flush(self.block)
+            self.block = []
+
+    def close(self):
+        """
+        Send the rest of records and wait until the sink takes all of them
+        """
+        if self.block:
+            self.flush(self.block)
+            self.block = []
+        self.flush(None)
+        self.drained.result()
@@ -0,0 +1,97 @@
+from itertools import islice
+
+import os
+import pickle
+import struct
+import tempfile
+import zlib
+
+CACHE_MAX_BYTES = 1024 * 1024 * 1024
+CACHE_BLOCK_SIZE = 4096
+SUFFIX = '.records'
+_HEADER = struct.Struct('<I')
+
+
+class ResultCache:
+    """
+    Directory of record streams stored by key as zlib compressed pickled blocks.
+    Least recently used entries are evicted once total size exceeds max_bytes.
+    """
+    def __init__(self, path, max_bytes=CACHE_MAX_BYTES, block_size=CACHE_BLOCK_SIZE):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        os.makedirs(path, exist_ok=True)
+
+    def filename(self, key):
+        return os.path.join(self.path, key + SUFFIX)
+
+    def __contains__(self, key):
+        return os.path.exists(self.filename(key))
+
+    def get(self, key):
+        """
+        Iterator over records stored by key, None if there are none
+        """
+        filename = self.filename(key)
+        try:
+            f = open(filename, 'rb')
+        except FileNotFoundError:
+            return None
+        os.utime(filename)
+        return self._read(f)
+
+    @staticmethod
+    def _read(f):
+        with f:
+            while True:
+                header = f.read(_HEADER.size)
+                if not header:
+                    return
+                size, = _HEADER.unpack(header)
+                for r in pickle.loads(zlib.decompress(f.read(size))):
+                    yield r
+
+    def put(self, key, records):
+        """
+        Pass records through while storing them by key. The entry appears
+        atomically once records are exhausted and is dropped if they are not.
+        """
+        fd, temp = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                records = iter(records)
+                while True:
+                    block = list(islice(records, self.block_size))
+                    if not block:
+                        break
+                    data = zlib.compress(pickle.dumps(block, pickle.HIGHEST_PROTOCOL))
+                    f.write(_HEADER.pack(len(data)))
+                    f.write(data)
+                    for r in block:
+                        yield r
+            os.replace(temp, self.filename(key))
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith(SUFFIX):
+                try:
+                    stat = os.stat(os.path.join(self.path, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -0,0 +1,396 @@
+"""
+Execution of plans on worker processes connected over TCP.
+
+Workers keep datasets as hash partitions, every partition is a list of runs
+sorted by order of the plan node that produced them. The coordinator runs
+plan nodes one after another on all workers: nodes grouping records by keys
+get their inputs partitioned by these keys, workers shuffle records to each
+other directly. Sources, sinks and nodes that can't be pickled run in the
+coordinator on gathered records. Runs of different workers are merged in
+order of worker: records with equal keys don't keep their order in the input.
+
+Start a worker with
+
+    python -m lib.cluster host:port authkey
+
+Workers run graphs unpickled from the coordinator, so the authkey is all
+that keeps others from running arbitrary code on them: it must be secret.
+"""
+from collections import defaultdict
+from itertools import chain
+from multiprocessing.connection import Listener, Client
+from numbers import Number
+
+import heapq
+import multiprocessing
+import os
+import pickle
+import sys
+import threading
+import traceback
+import zlib
+
+from lib.records import key_getter
+from lib.mr import picklable, stage_head, Graph, FuseMe, BatchMe, MapMe, SortMe, ReduceMe, AggregateMe, TopKMe, JoinMe
+
+SHUFFLE_BLOCK_SIZE = 4096
+COORDINATOR = -1
+
+
+def partition_of(key, partitions):
+    """
+    Stable partition of values of keys, the same in every process. Numbers are
+    taken by hash, which is the same for equal numbers of any type, such as 1,
+    1.0 and True, and unlike hash of strings doesn't change between processes
+    """
+    key = tuple(hash(v) if isinstance(v, Number) else v for v in key)
+    return zlib.crc32(pickle.dumps(key, pickle.HIGHEST_PROTOCOL)) % partitions
+
+
+def merge_runs(runs, order):
+    if order and len(runs) > 1:
+        return heapq.merge(*runs, key=key_getter(order))
+    return chain(*runs)
+
+
+def keyed(graph):
+    """
+    Graph needing all records with the same keys in one partition, or None
+    """
+    graph = stage_head(graph)
+    if isinstance(graph, (ReduceMe, AggregateMe, TopKMe, JoinMe)):
+        return graph
+    return None
+
+
+def output_partitioning(graph, partitioning):
+    """
+    Keys output of graph is partitioned by, given partitioning of its input
+    """
+    mappers = []
+    if isinstance(graph, (FuseMe, BatchMe)):
+        graph, mappers = graph.graph, graph.mappers
+
+    if isinstance(graph, MapMe):
+        mappers = [graph.mapper] + mappers
+    elif isinstance(graph, ReduceMe):
+        kept = graph.reducer.kept_order(tuple(sorted(graph.keys)), graph.keys)
+        partitioning = tuple(sorted(graph.keys)) if len(kept) == len(graph.keys) else None
+    elif keyed(graph) is not None:
+        partitioning = tuple(sorted(graph.keys))
+    elif graph is not None and not isinstance(graph, SortMe):
+        return None
+
+    for m in mappers:
+        if partitioning is not None and len(m.kept_order(partitioning)) != len(partitioning):
+            return None
+    return partitioning
+
+
+class ShuffleMe(Graph):
+    def __call__(self, records, **kwargs):
+        return records
+
+
+class Worker:
+    """
+    Server keeping partitions of datasets and running plan nodes on them
+    """
+    def __init__(self, address, authkey):
+        self.listener = Listener(address, authkey=authkey)
+        self.address = self.listener.address
+        self.authkey = authkey
+        self.lock = threading.Lock()
+        self.datasets = {}
+        self.peers = []
+        self.index = None
+        self.connections = {}
+        self.connection_locks = defaultdict(threading.Lock)
+
+    def serve_forever(self):
+        while True:
+            try:
+                conn = self.listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    def handle(self, conn):
+        with conn:
+            while True:
+                try:
+                    message = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    result = getattr(self, 'do_' + message[0])(*message[1:])
+                except Exception:
+                    conn.send(('error', traceback.format_exc()))
+                else:
+                    conn.send(('ok', result))
+                if message[0] == 'stop':
+                    os._exit(0)
+
+    def do_peers(self, addresses, index):
+        self.peers = addresses
+        self.index = index
+
+    def do_put(self, dataset, sender, records):
+        with self.lock:
+            self.datasets.setdefault(dataset, {}).setdefault(sender, []).extend(records)
+
+    def take(self, dataset, keep):
+        with self.lock:
+            runs = self.datasets.get(dataset, {}) if keep else self.datasets.pop(dataset, {})
+        return [runs[sender] for sender in sorted(runs)]
+
+    def do_fetch(self, dataset, keep):
+        return self.take(dataset, keep)
+
+    def do_run(self, graph, inputs, output):
+        params = {}
+        for name, (dataset, order, keep) in inputs.items():
+            runs = self.take(dataset, keep)
+            if keep:
+                runs = [[r.copy() for r in run] for run in runs]
+            params[name] = merge_runs(runs, order)
+        dataset, keys = output
+        records = graph(**params)
+        if keys is None:
+            self.do_put(dataset, self.index, list(records))
+            return
+
+        blocks = [[] for _ in self.peers]
+        get_key = key_getter(keys)
+        for r in records:
+            i = partition_of(get_key(r), len(self.peers))
+            blocks[i].append(r)
+            if len(blocks[i]) >= SHUFFLE_BLOCK_SIZE:
+                self.send(i, dataset, blocks[i])
+                blocks[i] = []
+        for i, block in enumerate(blocks):
+            if block:
+                self.send(i, dataset, block)
+
+    def send(self, peer, dataset, block):
+        if peer == self.index:
+            self.do_put(dataset, self.index, block)
+            return
+        with self.connection_locks[peer]:
+            conn = self.connections.get(peer)
+            if conn is None:
+                conn = self.connections[peer] = Client(self.peers[peer], authkey=self.authkey)
+            conn.send(('put', dataset, self.index, block))
+            status, result = conn.recv()
+        if status == 'error':
+            raise RuntimeError(result)
+
+    def do_clear(self):
+        with self.lock:
+            self.datasets.clear()
+
+    def do_stop(self):
+        for conn in self.connections.values():
+            conn.close()
+
+
+def serve(address, authkey, ready=None):
+    worker = Worker(address, authkey)
+    if ready is not None:
+        ready.send(worker.address)
+        ready.close()
+    worker.serve_forever()
+
+
+def start_local_workers(n, authkey=None):
+    """
+    Start n worker processes listening on free ports of localhost, return
+    the processes, their addresses and authkey, random unless given
+    """
+    if authkey is None:
+        authkey = os.urandom(32)
+    context = multiprocessing.get_context('spawn')
+    processes, addresses = [], []
+    for _ in range(n):
+        parent, child = context.Pipe()
+        process = context.Process(target=serve, args=(('localhost', 0), authkey, child), daemon=True)
+        process.start()
+        addresses.append(parent.recv())
+        processes.append(process)
+    return processes, addresses, authkey
+
+
+class Cluster:
+    """
+    Coordinator of workers at given addresses, runs plans with
+    FireMR.run(cluster=cluster)
+    """
+    def __init__(self, addresses, authkey):
+        self.addresses = list(addresses)
+        self.connections = [Client(address, authkey=authkey) for address in self.addresses]
+        self.call_all([('peers', self.addresses, i) for i in range(len(self.addresses))])
+        self.next_dataset = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def call_all(self, messages):
+        """
+        Send one message to every worker and wait for all of them
+        """
+        for conn, message in zip(self.connections, messages):
+            conn.send(message)
+        results, errors = [], []
+        for conn in self.connections:
+            status, result = conn.recv()
+            (errors if status == 'error' else results).append(result)
+        if errors:
+            raise RuntimeError("Worker failed:\n{}".format(errors[0]))
+        return results
+
+    def call(self, worker, *message):
+        self.connections[worker].send(message)
+        status, result = self.connections[worker].recv()
+        if status == 'error':
+            raise RuntimeError("Worker failed:\n{}".format(result))
+        return result
+
+    def dataset(self):
+        self.next_dataset += 1
+        return self.next_dataset
+
+    def scatter(self, records, dataset, keys):
+        """
+        Send records to workers, partitioned by keys or in turns by blocks
+        """
+        n = len(self.connections)
+        blocks = [[] for _ in range(n)]
+        turn = 0
+        get_key = key_getter(keys or ())
+        for r in records:
+            i = partition_of(get_key(r), n) if keys is not None else turn
+            blocks[i].append(r)
+            if len(blocks[i]) >= SHUFFLE_BLOCK_SIZE:
+                self.call(i, 'put', dataset, COORDINATOR, blocks[i])
+                blocks[i] = []
+                turn = (turn + 1) % n
+        for i, block in enumerate(blocks):
+            if block:
+                self.call(i, 'put', dataset, COORDINATOR, block)
+
+    def gather(self, dataset, order, keep):
+        runs = [run for runs in self.call_all([('fetch', dataset, keep)] * len(self.connections)) for run in runs]
+        return merge_runs(runs, order)
+
+    def is_local(self, node):
+        """
+        Node runs in the coordinator: sources, sinks, global limits, graphs
+        running their own process pools and graphs that can't be pickled
+        """
+        head = stage_head(node.graph)
+        return not node.params or head.local or (isinstance(head, SortMe) and head.limit is not None) \
+            or bool(getattr(head, 'workers', None)) or bool(getattr(head, 'partitions', None)) \
+            or not picklable(node.graph)
+
+    def partitioning(self, plan):
+        """
+        Partitioning of every node output and keys to shuffle node inputs by
+        """
+        consumers = plan.consumers()
+        partitioning, shuffles = {}, {}
+        for node in plan.nodes:
+            graph = keyed(node.graph)
+            if graph is not None and not self.is_local(node):
+                keys = tuple(sorted(graph.keys))
+                inputs = list(node.params.items())
+                given = [partitioning[i] for _, i in inputs]
+                if any(p is None or not set(p) <= set(keys) for p in given) or len(set(given)) > 1:
+                    for name, i in inputs:
+                        if partitioning[i] == keys:
+                            continue
+                        if consumers[i] == 1:
+                            shuffles[i] = keys
+                            partitioning[i] = keys
+                        else:
+                            shuffles[node, name] = keys
+
+            if self.is_local(node):
+                partitioning[node] = None
+            else:
+                inputs = set(partitioning[i] for i in node.inputs)
+                partitioning[node] = output_partitioning(node.graph, inputs.pop() if len(inputs) == 1 else None)
+        return partitioning, shuffles
+
+    def execute(self, plan, **kwargs):
+        consumers = plan.consumers()
+        partitioning, shuffles = self.partitioning(plan)
+        datasets = {}
+        output = None
+
+        def take(node):
+            consumers[node] -= 1
+            return datasets[node], node.order, consumers[node] > 0
+
+        try:
+            for node in plan.nodes:
+                keys = shuffles.get(node)
+                if self.is_local(node):
+                    params = {}
+                    for name, i in node.params.items():
+                        params[name] = self.gather(*take(i))
+                    records = node.graph(**params, **kwargs)
+                    if node is plan.output:
+                        records = output = list(records)
+                    datasets[node] = self.dataset()
+                    if consumers[node] > (node is plan.output):
+                        self.scatter(records, datasets[node], keys)
+                    else:
+                        for _ in records:
+                            pass
+                    continue
+
+                inputs = {}
+                for name, i in node.params.items():
+                    dataset, order, keep = take(i)
+                    if (node, name) in shuffles:
+                        shuffled = self.dataset()
+                        self.call_all([('run', ShuffleMe(), {'records': (dataset, order, keep)},
+                                        (shuffled, shuffles[node, name]))] * len(self.connections))
+                        dataset, keep = shuffled, False
+                    inputs[name] = dataset, order, keep
+                datasets[node] = self.dataset()
+                self.call_all([('run', node.graph, inputs, (datasets[node], keys))] * len(self.connections))
+
+            if output is None:
+                consumers[plan.output] -= 1
+                output = list(self.gather(datasets[plan.output], plan.output.order, False))
+            return output
+        finally:
+            self.call_all([('clear',)] * len(self.connections))
+
+    def shutdown(self):
+        """
+        Stop all workers, every worker process exits after its reply
+        """
+        self.call_all([('stop',)] * len(self.connections))
+        self.close()
+
+    def close(self):
+        for conn in self.connections:
+            conn.close()
+        self.connections = []
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 2 or not argv[1]:
+        sys.exit("Usage: python -m lib.cluster host:port authkey")
+    host, port = argv[0].rsplit(':', 1)
+    serve((host, int(port)), argv[1].encode())
+
+
+if __name__ == '__main__':
+    main()
@@ -1,52 +1,438 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, as_completed, FIRST_COMPLETED
 from copy import copy
-from itertools import groupby
+from itertools import groupby, islice, chain
+from operator import itemgetter
 from abc import abstractmethod
 
+import asyncio
+import contextvars
+import glob
+import hashlib
+import heapq
+import io
+import locale
+import os
+import pickle
+import sys
+import tempfile
+import types
 import logging
 logger = logging.getLogger(__name__)
 
+from lib.aio import AsyncSource, AsyncSink, AIO_QUEUE_SIZE, RUNNING_LOOP
+from lib.cache import ResultCache
+from lib.profiling import Profiler
+from lib.records import key_getter, make_rows, Schema
+from lib.operations import order_prefix, aggregated_columns, MultiAggregator, \
+    InnerJoiner, OuterJoiner, LeftJoiner, RightJoiner
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+SPILL_BLOCK_SIZE = 1024
+SIZE_SAMPLE = 100
+TEE_BUFFER_SIZE = 64 * SPILL_BLOCK_SIZE
+MAP_CHUNK_SIZE = 1024
+BROADCAST_LIMIT = 1024
+HASH_JOIN_LIMIT = 1024 * 1024
+JOIN_SORT_MEMORY_LIMIT = 256 * 1024 * 1024
+COMBINE_CHUNK_SIZE = 64 * 1024
+READ_BUFFER_SIZE = 1024 * 1024
+READ_CHUNK_SIZE = 16 * READ_BUFFER_SIZE
+
+
+def estimate_size(records):
+    """
+    Average size in bytes of one record, estimated by its dict and values
+    """
+    if not records:
+        return 0
+    total = 0
+    for r in records:
+        total += sys.getsizeof(r) + sum(sys.getsizeof(v) for v in r.values())
+    return total // len(records)
+
+
+class SpillFile:
+    """
+    Temporary file keeping runs of records as pickled blocks
+    """
+    def __init__(self, block_size=SPILL_BLOCK_SIZE):
+        self.block_size = block_size
+        self.file = tempfile.TemporaryFile()
+
+    def write(self, records):
+        """
+        Append records to the end of file, return (start, end) offsets of the run
+        """
+        self.file.seek(0, 2)
+        start = self.file.tell()
+        block = []
+        for r in records:
+            block.append(r)
+            if len(block) >= self.block_size:
+                pickle.dump(block, self.file, pickle.HIGHEST_PROTOCOL)
+                block = []
+        if block:
+            pickle.dump(block, self.file, pickle.HIGHEST_PROTOCOL)
+        return start, self.file.tell()
+
+    def read(self, start, end):
+        """
+        Iterate records of the run between start and end offsets
+        """
+        position = start
+        while position < end:
+            self.file.seek(position)
+            block = pickle.load(self.file)
+            position = self.file.tell()
+            for r in block:
+                yield r
+
+    def close(self):
+        self.file.close()
+
+
+def picklable(obj):
+    try:
+        pickle.dumps(obj)
+    except (pickle.PicklingError, AttributeError, TypeError):
+        return False
+    return True
+
+
+def chunks(records, chunk_size):
+    records = iter(records)
+    while True:
+        chunk = list(islice(records, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def pool_map(function, tasks, workers, ordered=True):
+    """
+    Apply function to each tuple of arguments from tasks in a process pool.
+    At most 2 * workers tasks are in flight, results are yielded in order of
+    tasks if ordered else as soon as they are ready.
+    """
+    with ProcessPoolExecutor(workers) as pool:
+        if ordered:
+            pending = deque()
+            for task in tasks:
+                pending.append(pool.submit(function, *task))
+                if len(pending) >= 2 * workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+            return
+
+        pending = set()
+        for task in tasks:
+            pending.add(pool.submit(function, *task))
+            if len(pending) >= 2 * workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        for future in as_completed(pending):
+            yield future.result()
+
+
+def map_chunk(mapper, chunk):
+    return [m for r in chunk for m in mapper(r)]
+
+
+def input_files(filenames):
+    """
+    Expand a file name, a glob pattern or a list of them into a list of files
+    """
+    if isinstance(filenames, str):
+        filenames = [filenames]
+    files = []
+    for name in filenames:
+        if glob.has_magic(name):
+            matched = sorted(glob.glob(name))
+            if not matched:
+                raise FileNotFoundError("No files match {}".format(name))
+            files.extend(matched)
+        else:
+            files.append(name)
+    return files
+
+
+def file_ranges(filename, chunk_size):
+    """
+    Split file into byte ranges of about chunk_size bytes, every range ends
+    right after a newline or at the end of file
+    """
+    size = os.path.getsize(filename)
+    with open(filename, 'rb') as f:
+        start = 0
+        while start < size:
+            f.seek(min(start + chunk_size, size) - 1)
+            f.readline()
+            end = f.tell()
+            yield filename, start, end
+            start = end
+
+
+def parse_range(parser, filename, start, end, schema=None, encoding=None):
+    """
+    Parse lines of a byte range of file decoded as open would decode them:
+    with encoding or the locale encoding if it's None
+    """
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    text = data.decode(encoding or locale.getpreferredencoding(False))
+    return list(read_rows((parser(line) for line in io.StringIO(text, newline=None)), schema))
+
+
+def source_schema(schema):
+    """
+    Schema records of a source are converted to: None to keep dict records,
+    True to infer schemas from records, a Schema or a list of columns
+    """
+    if schema is None or schema is True or isinstance(schema, Schema):
+        return schema
+    return Schema(schema)
+
+
+def read_rows(records, schema):
+    if schema is None:
+        return records
+    return make_rows(records, None if schema is True else schema)
+
+
+def reduce_partition(graph, records):
+    if getattr(graph, 'strategy', None) == 'hash':
+        return sorted(((key, [state]) for key, state in graph.hash_states(records)), key=itemgetter(0))
+    records.sort(key=graph.get_key)
+    return [(key, list(graph.reduce_group(key, group))) for key, group in groupby(records, key=graph.get_key)]
+
+
+def shuffle(graph, records):
+    """
+    Hash partition records by keys of reduce-like graph, sort and reduce every
+    partition in its own process, merge the results back in order of keys
+    """
+    parts = [[] for _ in range(graph.partitions)]
+    for r in records:
+        parts[hash(graph.get_key(r)) % graph.partitions].append(r)
+    tasks = [(graph, part) for part in parts if part]
+
+    if picklable(graph):
+        results = list(pool_map(reduce_partition, tasks, graph.partitions))
+    else:
+        logger.warning("{} can't be pickled, reducing partitions in one process".format(graph.__class__.__name__))
+        results = [reduce_partition(*task) for task in tasks]
+
+    for key, group in heapq.merge(*results, key=itemgetter(0)):
+        for r in group:
+            yield r
+
+
+def read_smaller(first, second, limit=None, block_size=SPILL_BLOCK_SIZE):
+    """
+    Read two streams in turns until one of them ends or limit records are read from both.
+    Return index of the exhausted stream (or None) and both streams, the exhausted one as a list.
+    """
+    streams = [iter(first), iter(second)]
+    buffers = [[], []]
+    while limit is None or len(buffers[0]) < limit:
+        for i in (0, 1):
+            block = list(islice(streams[i], block_size))
+            buffers[i].extend(block)
+            if len(block) < block_size:
+                streams[1 - i] = chain(buffers[1 - i], streams[1 - i])
+                streams[i] = buffers[i]
+                return i, streams[0], streams[1]
+    return None, chain(buffers[0], streams[0]), chain(buffers[1], streams[1])
+
+
+def to_columns(rows):
+    """
+    Columns of rows, None if rows have different columns
+    """
+    columns = set(rows[0])
+    for r in rows:
+        if len(r) != len(columns) or not columns.issuperset(r):
+            return None
+    return {k: [r[k] for r in rows] for k in rows[0]}
+
+
+def to_rows(columns):
+    names = list(columns)
+    values = [v.tolist() if hasattr(v, 'tolist') else v for v in columns.values()]
+    return [dict(zip(names, row)) for row in zip(*values)]
+
 
 class Graph:
+    local = False
+
     @abstractmethod
     def __call__(self, *args, **kwargs):
         pass
 
+    def output_order(self, orders):
+        """
+        Columns output is sorted by, given sort orders of inputs by parameter name
+        """
+        return ()
+
+    def input_fingerprint(self, **kwargs):
+        """
+        Bytes identifying data the graph reads besides its inputs, None if unknown
+        """
+        return b''
+
+
+class KeyedGraph(Graph):
+    """
+    Graph grouping or ordering records by values of keys, read by get_key
+    compiled from keys. It's compiled again when the graph is unpickled.
+    """
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['get_key']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.get_key = key_getter(self.keys)
+
 
 class MapMe(Graph):
-    def __init__(self, mapper):
+    def __init__(self, mapper, workers=None, chunk_size=MAP_CHUNK_SIZE, ordered=True):
         self.mapper = mapper
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.ordered = ordered
+
+    def output_order(self, orders):
+        kept_order = getattr(self.mapper, 'kept_order', None)
+        if kept_order is None or (self.workers and not self.ordered):
+            return ()
+        return kept_order(orders['records'])
 
     def __call__(self, records, **kwargs):
+        if self.workers:
+            if picklable(self.mapper):
+                tasks = ((self.mapper, chunk) for chunk in chunks(records, self.chunk_size))
+                for chunk in pool_map(map_chunk, tasks, self.workers, self.ordered):
+                    for r in chunk:
+                        yield r
+                return
+            logger.warning("Mapper {} can't be pickled, running it in one process".format(
+                self.mapper.__class__.__name__))
+
         for r in records:
             for r in self.mapper(r):
                 yield r
 
 
-class ReduceMe(Graph):
-    def __init__(self, reducer, keys):
+class ReduceMe(KeyedGraph):
+    def __init__(self, reducer, keys, partitions=None):
         self.reducer = reducer
         self.keys = keys
+        self.get_key = key_getter(keys)
+        self.partitions = partitions
+
+    def reduce_group(self, key, group):
+        return self.reducer(group)
+
+    def output_order(self, orders):
+        kept_order = getattr(self.reducer, 'kept_order', None)
+        if kept_order is None:
+            return ()
+        return kept_order(tuple(self.keys) if self.partitions else orders['records'], self.keys)
 
     def __call__(self, records, **kwargs):
-        for key, group in groupby(records, key=lambda x: tuple(x[k] for k in self.keys)):
-            for r in self.reducer(group):
+        if self.partitions:
+            for r in shuffle(self, records):
+                yield r
+            return
+
+        for key, group in groupby(records, key=self.get_key):
+            for r in self.reduce_group(key, group):
                 yield r
 
 
-class JoinMe(Graph):
-    def __init__(self, joiner, keys):
+class JoinMe(KeyedGraph):
+    def __init__(self, joiner, keys, strategy='merge'):
+        if strategy not in ('merge', 'hash', 'broadcast', 'auto'):
+            raise ValueError("Unknown join strategy: {}".format(strategy))
         self.keys = keys
+        self.get_key = key_getter(keys)
         self.joiner = joiner
+        self.strategy = strategy
 
     def grouper(self, records):
         for key, group in groupby(records, key=self.get_key):
             yield key, group
         yield None, None
 
-    def get_key(self, record):
-        return tuple(record[k] for k in self.keys)
+    def output_order(self, orders):
+        return tuple(self.keys) if self.strategy == 'merge' else ()
 
     def __call__(self, first_records, second_records, **kwargs):
+        strategy = self.strategy
+        build_first = False
+        if strategy == 'broadcast':
+            second_records = list(second_records)
+        elif strategy in ('hash', 'auto'):
+            limit = HASH_JOIN_LIMIT if strategy == 'auto' else None
+            smaller, first_records, second_records = read_smaller(first_records, second_records, limit)
+            build_first = smaller == 0
+            if smaller is None:
+                strategy = 'merge'
+                sort = SortMe(self.keys, JOIN_SORT_MEMORY_LIMIT)
+                first_records, second_records = sort(first_records), sort(second_records)
+            elif strategy == 'auto':
+                small = first_records if build_first else second_records
+                strategy = 'broadcast' if len(small) <= BROADCAST_LIMIT else 'hash'
+
+        if strategy == 'merge':
+            joined = self.merge_join(first_records, second_records)
+        elif build_first:
+            joined = self.hash_join(second_records, first_records, True, strategy == 'hash')
+        else:
+            joined = self.hash_join(first_records, second_records, False, strategy == 'hash')
+
+        for r in joined:
+            yield r
+
+    def hash_join(self, probe, build, build_first, grouped):
+        """
+        Join probe stream with build records kept in a dict by key. Probe records are
+        passed to joiner by groups of consecutive equal keys if grouped else one by one.
+        """
+        table = {}
+        for r in build:
+            table.setdefault(self.get_key(r), []).append(r)
+
+        if grouped:
+            groups = groupby(probe, key=self.get_key)
+        else:
+            groups = ((self.get_key(r), [r]) for r in probe)
+
+        matched = set()
+        for key, group in groups:
+            bucket = table.get(key, [])
+            if bucket:
+                matched.add(key)
+            for r in self.joiner(*((bucket, group) if build_first else (group, bucket))):
+                yield r
+
+        for key, bucket in table.items():
+            if key not in matched:
+                for r in self.joiner(*((bucket, []) if build_first else ([], bucket))):
+                    yield r
+
+    def merge_join(self, first_records, second_records):
         first_grouper = self.grouper(first_records)
         second_grouper = self.grouper(second_records)
         first_key, first_g = next(first_grouper)
@@ -83,29 +469,306 @@ class JoinMe(Graph):
             second_key, second_g = next(second_grouper)
 
 
-class AggregateMe(Graph):
-    def __init__(self, aggregator, keys):
+class AggregateMe(KeyedGraph):
+    batch_size = None
+    combined = False
+
+    def __init__(self, aggregator, keys, partitions=None, strategy='sort', sort_output=False):
+        if strategy not in ('sort', 'hash'):
+            raise ValueError("Unknown aggregation strategy: {}".format(strategy))
         self.aggregator = aggregator
         self.keys = keys
+        self.get_key = key_getter(keys)
+        self.partitions = partitions
+        self.strategy = strategy
+        self.sort_output = sort_output
+
+    def folder(self):
+        """
+        Function folding one record into state: partial states of CombineMe
+        are merged if aggregate is combined, raw records are aggregated otherwise
+        """
+        if self.combined:
+            merge = self.aggregator.merge
+            return lambda r, state: merge(state, r)
+        return self.aggregator
+
+    def reduce_group(self, key, group):
+        state = {k: v for k, v in zip(self.keys, key)}
+        if self.batch_size and not self.combined:
+            for chunk in chunks(group, self.batch_size):
+                columns = to_columns(chunk)
+                if columns is None:
+                    for g in chunk:
+                        state = self.aggregator(g, state)
+                else:
+                    state = self.aggregator.batch(columns, state)
+            return [state]
+
+        fold = self.folder()
+        for g in group:
+            state = fold(g, state)
+        return [state]
+
+    def hash_states(self, records):
+        fold = self.folder()
+        states = {}
+        for r in records:
+            key = self.get_key(r)
+            state = states.get(key)
+            if state is None:
+                state = {k: v for k, v in zip(self.keys, key)}
+            states[key] = fold(r, state)
+        return states.items()
+
+    def output_order(self, orders):
+        if self.partitions or (self.strategy == 'hash' and self.sort_output):
+            return tuple(self.keys)
+        if self.strategy == 'hash':
+            return ()
+        return order_prefix(orders['records'], [k for k in orders['records'] if k not in self.keys])
 
     def __call__(self, records, **kwargs):
-        for key, group in groupby(records, key=lambda x: tuple(x[k] for k in self.keys)):
-            state = {k: v for k, v in zip(self.keys, key)}
-            for g in group:
-                state = self.aggregator(g, state)
+        if self.partitions:
+            for r in shuffle(self, records):
+                yield r
+            return
+
+        if self.strategy == 'hash':
+            states = self.hash_states(records)
+            if self.sort_output:
+                states = sorted(states, key=itemgetter(0))
+            for key, state in states:
+                yield state
+            return
+
+        for key, group in groupby(records, key=self.get_key):
+            for r in self.reduce_group(key, group):
+                yield r
+
+
+class CombineMe(KeyedGraph):
+    """
+    Pre-aggregate records into partial states of combinable aggregator.
+    At most chunk_size keys are kept, states are emitted when it's exceeded.
+    """
+    def __init__(self, aggregator, keys, chunk_size=COMBINE_CHUNK_SIZE):
+        self.aggregator = aggregator
+        self.keys = keys
+        self.get_key = key_getter(keys)
+        self.chunk_size = chunk_size
+
+    def __call__(self, records, **kwargs):
+        states = {}
+        for r in records:
+            key = self.get_key(r)
+            state = states.get(key)
+            if state is None:
+                if len(states) >= self.chunk_size:
+                    for state in states.values():
+                        yield state
+                    states = {}
+                state = {k: v for k, v in zip(self.keys, key)}
+            states[key] = self.aggregator(r, state)
+
+        for state in states.values():
             yield state
 
 
-class SortMe(Graph):
-    def __init__(self, keys):
+class CombineReduceMe(KeyedGraph):
+    """
+    Reduce parts of groups of combinable reducer. Records are grouped by keys
+    in chunks of at most chunk_size records, groups are reduced when it's full.
+    """
+    def __init__(self, reducer, keys, chunk_size=COMBINE_CHUNK_SIZE):
+        self.reducer = reducer
         self.keys = keys
+        self.get_key = key_getter(keys)
+        self.chunk_size = chunk_size
 
     def __call__(self, records, **kwargs):
-        for r in sorted(records, key=lambda x: tuple(x[k] for k in self.keys)):
-            yield r
+        groups = {}
+        for count, r in enumerate(records, 1):
+            groups.setdefault(self.get_key(r), []).append(r)
+            if count % self.chunk_size == 0:
+                for group in groups.values():
+                    for r in self.reducer(group):
+                        yield r
+                groups = {}
+
+        for group in groups.values():
+            for r in self.reducer(group):
+                yield r
+
+
+class SortMe(KeyedGraph):
+    def __init__(self, keys, memory_limit=None, limit=None):
+        self.keys = keys
+        self.get_key = key_getter(keys)
+        self.memory_limit = memory_limit
+        self.limit = limit
+
+    def output_order(self, orders):
+        return tuple(self.keys)
+
+    def __call__(self, records, **kwargs):
+        if self.limit is not None:
+            for r in heapq.nsmallest(self.limit, records, key=self.get_key):
+                yield r
+            return
+
+        if self.memory_limit is None:
+            for r in sorted(records, key=self.get_key):
+                yield r
+            return
+
+        records = iter(records)
+        sample = list(islice(records, SIZE_SAMPLE))
+        run_length = max(1, self.memory_limit // max(1, estimate_size(sample)))
+        records = chain(sample, records)
+
+        run = list(islice(records, run_length + 1))
+        if len(run) <= run_length:
+            run.sort(key=self.get_key)
+            for r in run:
+                yield r
+            return
+
+        records = chain(run[run_length:], records)
+        run = run[:run_length]
+        spill = SpillFile()
+        try:
+            runs = []
+            while run:
+                run.sort(key=self.get_key)
+                runs.append(spill.write(run))
+                run = list(islice(records, run_length))
+            for r in heapq.merge(*(spill.read(*offsets) for offsets in runs), key=self.get_key):
+                yield r
+        finally:
+            spill.close()
+
+
+def compile_mappers(mappers):
+    """
+    Compile a chain of mappers into one generator over records made of nested loops
+    """
+    lines = ["def fused(r0):", "    for r1 in r0:"]
+    for i in range(len(mappers)):
+        lines.append("{}for r{} in m{}(r{}):".format("    " * (i + 2), i + 2, i, i + 1))
+    lines.append("{}yield r{}".format("    " * (len(mappers) + 2), len(mappers) + 1))
+    namespace = {"m{}".format(i): m for i, m in enumerate(mappers)}
+    exec("\n".join(lines), namespace)
+    return namespace["fused"]
+
+
+class FuseMe(Graph):
+    """
+    Single stage applying a chain of mappers to records or to the output of graph
+    """
+    def __init__(self, graph, mappers):
+        self.graph = graph
+        self.mappers = mappers
+        self.fused = compile_mappers(mappers)
+
+    def __getstate__(self):
+        return {'graph': self.graph, 'mappers': self.mappers}
+
+    def __setstate__(self, state):
+        self.__init__(state['graph'], state['mappers'])
+
+    def __call__(self, records, **kwargs):
+        if self.graph is not None:
+            records = self.graph(records, **kwargs)
+        return self.fused(records)
+
+
+class BatchMe(Graph):
+    """
+    Stage applying a chain of mappers to records or to the output of graph in
+    batches of batch_size rows. Mappers with batch method get column batches,
+    the rest are applied to rows converted back from columns. Batches of rows
+    with different columns are mapped as rows.
+    """
+    def __init__(self, graph, mappers, batch_size):
+        self.graph = graph
+        self.mappers = mappers
+        self.batch_size = batch_size
+        self.segments = []
+        for vectorized, segment in groupby(mappers, key=lambda m: hasattr(m, 'batch')):
+            segment = list(segment)
+            self.segments.append((vectorized, segment, compile_mappers(segment)))
+
+    def __getstate__(self):
+        return {'graph': self.graph, 'mappers': self.mappers, 'batch_size': self.batch_size}
+
+    def __setstate__(self, state):
+        self.__init__(state['graph'], state['mappers'], state['batch_size'])
+
+    def __call__(self, records, **kwargs):
+        if self.graph is not None:
+            records = self.graph(records, **kwargs)
+
+        for data in chunks(records, self.batch_size):
+            is_rows = True
+            for vectorized, segment, fused in self.segments:
+                if is_rows and not data:
+                    break
+                if vectorized and is_rows:
+                    columns = to_columns(data)
+                    if columns is not None:
+                        data, is_rows = columns, False
+                if vectorized and not is_rows:
+                    for mapper in segment:
+                        data = mapper.batch(data)
+                else:
+                    if not is_rows:
+                        data, is_rows = to_rows(data), True
+                    data = list(fused(data))
+
+            for r in (data if is_rows else to_rows(data)):
+                yield r
+
+
+class TopKMe(KeyedGraph):
+    """
+    Top n records by column for every key, kept in a bounded heap per key.
+    Equivalent to sort by keys and reduce with heapq.nlargest.
+    """
+    def __init__(self, column, n, keys):
+        self.column = column
+        self.n = n
+        self.keys = keys
+        self.get_key = key_getter(keys)
+
+    def output_order(self, orders):
+        return tuple(self.keys)
+
+    def __call__(self, records, **kwargs):
+        if self.n <= 0:
+            return
+
+        heaps = {}
+        for index, r in enumerate(records):
+            key = self.get_key(r)
+            heap = heaps.get(key)
+            if heap is None:
+                heap = heaps[key] = []
+
+            item = (r[self.column], -index, r)
+            if len(heap) < self.n:
+                heapq.heappush(heap, item)
+            elif item[:2] > heap[0][:2]:
+                heapq.heapreplace(heap, item)
+
+        for key in sorted(heaps):
+            for value, index, r in sorted(heaps.pop(key), key=itemgetter(0, 1), reverse=True):
+                yield r
 
 
 class SaveMe(Graph):
+    local = True
+
     def __init__(self, buffer):
         self.buffer = buffer
 
@@ -115,25 +778,604 @@ class SaveMe(Graph):
         return []
 
 class ReadMe(Graph):
-    def __init__(self, filename, parser):
+    local = True
+
+    def __init__(self, filename, parser, workers=None, chunk_size=READ_CHUNK_SIZE, ordered=True,
+                 buffer_size=READ_BUFFER_SIZE, schema=None, encoding=None):
         self.filename = filename
         self.parser = parser
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.ordered = ordered
+        self.buffer_size = buffer_size
+        self.schema = source_schema(schema)
+        self.encoding = encoding
 
     def __call__(self, **kwargs):
-        with open(self.filename) as f:
-            for line in f:
-                yield self.parser(line)
+        files = input_files(self.filename)
+        if self.workers:
+            if picklable(self.parser):
+                tasks = ((self.parser,) + r + (self.schema, self.encoding)
+                         for filename in files for r in file_ranges(filename, self.chunk_size))
+                for chunk in pool_map(parse_range, tasks, self.workers, self.ordered):
+                    for r in chunk:
+                        yield r
+                return
+            logger.warning("Parser {} can't be pickled, reading files in one process".format(self.parser))
+
+        for filename in files:
+            with open(filename, buffering=self.buffer_size, encoding=self.encoding) as f:
+                for r in read_rows(map(self.parser, f), self.schema):
+                    yield r
+
+    def input_fingerprint(self, **kwargs):
+        stats = []
+        for filename in input_files(self.filename):
+            stat = os.stat(filename)
+            stats.append("{}:{}:{}".format(os.path.abspath(filename), stat.st_mtime_ns, stat.st_size))
+        return "\n".join(stats).encode()
 
 
 class ReadIterMe(Graph):
-    def __init__(self, name):
+    local = True
+
+    def __init__(self, name, schema=None):
         self.name = name
+        self.schema = source_schema(schema)
 
     def __call__(self, **kwargs):
+        if self.schema is not None:
+            for r in read_rows(kwargs[self.name], self.schema):
+                yield r
+            return
+
         for r in kwargs[self.name]:
+            yield r.copy()
+
+    def input_fingerprint(self, **kwargs):
+        records = kwargs.get(self.name)
+        if not isinstance(records, (list, tuple)) or not picklable(records):
+            return None
+        return hashlib.sha1(pickle.dumps(records, pickle.HIGHEST_PROTOCOL)).digest()
+
+
+class AsyncReadIterMe(ReadIterMe):
+    """
+    Read records of an async iterable passed to run_async as they arrive
+    """
+    def input_fingerprint(self, **kwargs):
+        return None
+
+
+class AsyncSaveMe(Graph):
+    """
+    Await async sink for every record, the sink is a coroutine function
+    or an asyncio.Queue. Works only in graphs run by run_async.
+    """
+    local = True
+
+    def __init__(self, sink, queue_size=AIO_QUEUE_SIZE):
+        self.sink = sink
+        self.queue_size = queue_size
+
+    def __call__(self, records, **kwargs):
+        loop = RUNNING_LOOP.get()
+        if loop is None:
+            raise RuntimeError("Async sinks work only in graphs run by run_async")
+        put = self.sink.put if isinstance(self.sink, asyncio.Queue) else self.sink
+        sink = AsyncSink(put, loop, self.queue_size)
+        for r in records:
+            sink.send(r)
+        sink.close()
+        return []
+
+
+class CacheMe(Graph):
+    """
+    Pass records through, storing them in result cache under content hash of
+    the upstream subgraph and its inputs. Later runs over unchanged subgraph
+    and inputs read records from cache instead of computing them.
+    """
+    local = True
+    lineage = None
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def output_order(self, orders):
+        return orders['records']
+
+    def __call__(self, records, **kwargs):
+        key = None if self.lineage is None else lineage_key(self.lineage, kwargs)
+        if key is None:
+            logger.warning("Subgraph can't be fingerprinted, its results are not cached")
+            for r in records:
+                yield r
+            return
+
+        cached = self.cache.get(key)
+        if cached is None:
+            cached = self.cache.put(key, records)
+        for r in cached:
             yield r
 
 
+class Tee:
+    """
+    Share one record stream between several consumers.
+
+    Records are buffered in blocks until every consumer has read them. At most
+    buffer_size records are kept in memory, older blocks are spilled to disk.
+    Every consumer but the last one to read a block gets copies of its records,
+    so consumers may change records they own in place.
+    """
+    def __init__(self, records, consumers, buffer_size=TEE_BUFFER_SIZE, block_size=SPILL_BLOCK_SIZE):
+        self.records = iter(records)
+        self.consumers = consumers
+        self.block_size = block_size
+        self.max_blocks = max(1, buffer_size // block_size)
+        self.blocks = {}
+        self.readers = {}
+        self.in_memory = deque()
+        self.next_block = 0
+        self.exhausted = False
+        self.finished = 0
+        self.spill = None
+        self.iterators = [self._consume() for _ in range(consumers)]
+
+    def _fill(self):
+        block = list(islice(self.records, self.block_size))
+        if not block:
+            self.exhausted = True
+            return False
+
+        self.blocks[self.next_block] = block
+        self.readers[self.next_block] = self.consumers
+        self.in_memory.append(self.next_block)
+        self.next_block += 1
+
+        while len(self.in_memory) > self.max_blocks:
+            index = self.in_memory.popleft()
+            if self.spill is None:
+                self.spill = SpillFile(self.block_size)
+            self.blocks[index] = self.spill.write(self.blocks[index])
+        return True
+
+    def _take(self, index):
+        block = self.blocks[index]
+        self.readers[index] -= 1
+        if isinstance(block, tuple):
+            block = list(self.spill.read(*block))
+        elif self.readers[index]:
+            block = [r.copy() for r in block]
+
+        if not self.readers[index]:
+            del self.readers[index]
+            del self.blocks[index]
+            if index in self.in_memory:
+                self.in_memory.remove(index)
+        return block
+
+    def _consume(self):
+        index = 0
+        while index < self.next_block or (not self.exhausted and self._fill()):
+            for r in self._take(index):
+                yield r
+            index += 1
+
+        self.finished += 1
+        if self.finished == self.consumers and self.spill is not None:
+            self.spill.close()
+            self.spill = None
+
+
+class PlanNode:
+    def __init__(self, graph, params, order=(), sources=()):
+        self.graph = graph
+        self.params = params
+        self.order = order
+        self.sources = list(sources)
+
+    @property
+    def inputs(self):
+        return self.params.values()
+
+    @property
+    def name(self):
+        return self.graph.__class__.__name__
+
+    @property
+    def fusable(self):
+        if isinstance(self.graph, MapMe):
+            return not self.graph.workers
+        return isinstance(self.graph, (FuseMe, ReduceMe, AggregateMe))
+
+
+class Plan:
+    """
+    Optimized execution plan of graph path.
+
+    Every node knows the sort order its output is guaranteed to have,
+    sorts already satisfied by order of their input are dropped. Sibling
+    aggregates joined back by their keys are computed in one pass. Combinable
+    aggregates get records pre-aggregated by CombineMe and combinable reduces
+    pre-reduced by CombineReduceMe before the sort or shuffle preceding them.
+    Maps are fused with preceding maps, reduces and aggregates into one stage,
+    which runs on column batches if batch_size is set and numpy is available.
+    """
+    def __init__(self, path, batch_size=None):
+        self.nodes = []
+        self.notes = []
+        planned = {}
+        for p in path:
+            params = {k: planned[v] for k, v in p.params.items()}
+            orders = {k: v.order for k, v in params.items()}
+
+            if isinstance(p.graph, SortMe) and p.graph.limit is None:
+                order = orders['records']
+                if tuple(p.graph.keys) == order[:len(p.graph.keys)]:
+                    self.notes.append("SortMe({}) dropped, input is sorted by ({})".format(
+                        ", ".join(p.graph.keys), ", ".join(order)))
+                    planned[p] = params['records']
+                    continue
+
+            graph = p.graph
+            if isinstance(graph, CacheMe):
+                graph = copy(graph)
+                graph.lineage = p
+            node = PlanNode(graph, params, graph.output_order(orders), [p])
+            planned[p] = node
+            self.nodes.append(node)
+
+        self.output = planned[path[-1]]
+        self.share_scans()
+        self.combine()
+        self.fuse()
+        if batch_size:
+            if numpy is None:
+                logger.warning("numpy is not installed, batch mode is disabled")
+            else:
+                self.vectorize(batch_size)
+
+    def consumers(self):
+        consumers = {self.output: 1}
+        for node in self.nodes:
+            for i in node.inputs:
+                consumers[i] = consumers.get(i, 0) + 1
+        return consumers
+
+    def share_scans(self):
+        """
+        Replace join of two aggregates of one input by the same keys with one
+        aggregate computing both of them
+        """
+        consumers = self.consumers()
+
+        def sibling(node):
+            if isinstance(node.graph, SortMe) and node.graph.limit is None and consumers[node] == 1:
+                return [node] + sibling(node.params['records'])
+            if isinstance(node.graph, AggregateMe) and consumers[node] == 1:
+                return [node]
+            return []
+
+        removed = set()
+        for node in self.nodes:
+            graph = node.graph
+            if not isinstance(graph, JoinMe) or type(graph.joiner) not in (
+                    InnerJoiner, OuterJoiner, LeftJoiner, RightJoiner):
+                continue
+            first, second = sibling(node.params['first_records']), sibling(node.params['second_records'])
+            if not first or not second:
+                continue
+            first_graph, second_graph = first[-1].graph, second[-1].graph
+            records = first[-1].params['records']
+            if records is not second[-1].params['records'] or set(first_graph.keys) != set(graph.keys):
+                continue
+            if (list(first_graph.keys), first_graph.partitions, first_graph.strategy) != \
+                    (list(second_graph.keys), second_graph.partitions, second_graph.strategy):
+                continue
+            columns = [aggregated_columns(first_graph.aggregator), aggregated_columns(second_graph.aggregator)]
+            if None in columns or set(columns[0]) & set(columns[1]) or set(columns[0] + columns[1]) & set(graph.keys):
+                continue
+
+            aggregators = [first_graph.aggregator, second_graph.aggregator]
+            if isinstance(graph.joiner, RightJoiner):
+                aggregators.reverse()
+            shared = copy(first_graph)
+            shared.aggregator = MultiAggregator(aggregators)
+            order = shared.output_order({'records': records.order})
+            if order[:len(node.order)] != node.order and shared.strategy == 'hash':
+                shared.sort_output = True
+                order = shared.output_order({'records': records.order})
+            if order[:len(node.order)] != node.order:
+                continue
+
+            node.graph, node.params, node.order = shared, {'records': records}, order
+            node.sources = [s for n in first[::-1] + second[::-1] for s in n.sources] + node.sources
+            removed.update(first + second)
+            self.notes.append("{}, {} aggregated in one pass instead of {}".format(
+                first_graph.aggregator.__class__.__name__, second_graph.aggregator.__class__.__name__,
+                graph.joiner.__class__.__name__))
+        self.nodes = [node for node in self.nodes if node not in removed]
+
+    def combine(self):
+        consumers = self.consumers()
+        nodes = []
+        for node in self.nodes:
+            graph = node.graph
+            head = node.params.get('records')
+            if isinstance(graph, AggregateMe) and getattr(graph.aggregator, 'combinable', False):
+                combiner = CombineMe(graph.aggregator, graph.keys)
+            elif isinstance(graph, ReduceMe) and getattr(graph.reducer, 'combinable', False):
+                combiner = CombineReduceMe(graph.reducer, graph.keys)
+            else:
+                combiner = None
+
+            if combiner is not None:
+                if graph.partitions:
+                    target = node
+                elif isinstance(head.graph, SortMe) and head.graph.limit is None and consumers[head] == 1 \
+                        and set(head.graph.keys) == set(graph.keys):
+                    target = head
+                else:
+                    target = None
+
+                if target is not None:
+                    combine = PlanNode(combiner, target.params)
+                    target.params = {'records': combine}
+                    nodes.insert(nodes.index(target) if target is head else len(nodes), combine)
+                    if isinstance(graph, AggregateMe):
+                        node.graph = copy(graph)
+                        node.graph.combined = True
+                    operation = graph.aggregator if isinstance(graph, AggregateMe) else graph.reducer
+                    self.notes.append("{} combined before {}".format(operation.__class__.__name__, target.name))
+            nodes.append(node)
+        self.nodes = nodes
+
+    def fuse(self):
+        consumers = self.consumers()
+        fused = {}
+        nodes = []
+        for node in self.nodes:
+            node.params = {k: fused.get(v, v) for k, v in node.params.items()}
+            head = node.params.get('records')
+            if not (isinstance(node.graph, MapMe) and node.fusable and head.fusable and consumers[head] == 1):
+                nodes.append(node)
+                continue
+
+            if isinstance(head.graph, FuseMe):
+                head.graph = FuseMe(head.graph.graph, head.graph.mappers + [node.graph.mapper])
+            elif isinstance(head.graph, MapMe):
+                head.graph = FuseMe(None, [head.graph.mapper, node.graph.mapper])
+            else:
+                head.graph = FuseMe(head.graph, [node.graph.mapper])
+            head.order = node.order
+            head.sources.extend(node.sources)
+            consumers[head] = consumers[node]
+            fused[node] = head
+            if node is self.output:
+                self.output = head
+
+        self.nodes = nodes
+        for node in nodes:
+            if isinstance(node.graph, FuseMe):
+                stages = [] if node.graph.graph is None else [node.graph.graph.__class__.__name__]
+                stages.extend(m.__class__.__name__ for m in node.graph.mappers)
+                self.notes.append("{} fused into one stage".format(", ".join(stages)))
+
+    def vectorize(self, batch_size):
+        def batched(graph):
+            if isinstance(graph, AggregateMe) and graph.strategy == 'sort' and hasattr(graph.aggregator, 'batch'):
+                self.notes.append("{} runs on batches".format(graph.aggregator.__class__.__name__))
+                graph = copy(graph)
+                graph.batch_size = batch_size
+            return graph
+
+        for node in self.nodes:
+            graph = node.graph
+            if isinstance(graph, FuseMe):
+                head, mappers = batched(graph.graph), graph.mappers
+            elif isinstance(graph, MapMe) and node.fusable:
+                head, mappers = None, [graph.mapper]
+            else:
+                node.graph = batched(graph)
+                continue
+
+            if any(hasattr(m, 'batch') for m in mappers):
+                node.graph = BatchMe(head, mappers, batch_size)
+                self.notes.append("{} run on batches".format(", ".join(
+                    m.__class__.__name__ for m in mappers if hasattr(m, 'batch'))))
+            elif isinstance(graph, FuseMe) and head is not graph.graph:
+                node.graph = FuseMe(head, mappers)
+
+    def describe(self):
+        lines = ["Execution plan: {}".format(", ".join(node.name for node in self.nodes))]
+        lines.extend("Optimized: {}".format(note) for note in self.notes)
+        return "\n".join(lines)
+
+    def stream(self, buffer_size=TEE_BUFFER_SIZE, profiler=None, **kwargs):
+        """
+        Lazily chain outputs of plan nodes, return output iterator of the plan.
+        Outputs consumed by several nodes are shared through Tee. Every node
+        accounts its records and time to profiler if it's given.
+        """
+        consumers = self.consumers()
+        outputs = {}
+        for node in self.nodes:
+            params = {k: outputs[v].pop() for k, v in node.params.items()}
+            if profiler is None:
+                output = node.graph(**params, **kwargs)
+            else:
+                stats = profiler.node_stats(node.name, [graph_label(s.graph) for s in node.sources])
+                params = {k: profiler.records_in(stats, v) for k, v in params.items()}
+                output = profiler.records_out(stats, instrument(node.graph, profiler, stats), params, kwargs)
+            count = consumers.get(node, 0)
+            if count > 1:
+                outputs[node] = Tee(output, count, buffer_size).iterators
+            else:
+                outputs[node] = [output]
+
+        return outputs[self.output].pop()
+
+
+class CompiledPlan:
+    """
+    Immutable plan of a graph path for repeated runs: the plan, topological
+    order of its nodes, their inputs resolved to output slots and counts of
+    their consumers are computed once, execute only chains node outputs.
+    """
+    __slots__ = ('path', 'plan', 'buffer_size', 'steps', 'output', 'description')
+
+    def __init__(self, path, batch_size=None, buffer_size=TEE_BUFFER_SIZE):
+        plan = Plan(path, batch_size)
+        consumers = plan.consumers()
+        slots = {node: i for i, node in enumerate(plan.nodes)}
+        init = object.__setattr__
+        init(self, 'path', tuple(path))
+        init(self, 'plan', plan)
+        init(self, 'buffer_size', buffer_size)
+        init(self, 'steps', tuple((node.graph, tuple((k, slots[v]) for k, v in node.params.items()),
+                                   consumers.get(node, 0)) for node in plan.nodes))
+        init(self, 'output', slots[plan.output])
+        init(self, 'description', "Execution path: {}\n{}".format(
+            ", ".join(p.name for p in path), plan.describe()))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("CompiledPlan is immutable")
+
+    def execute(self, **inputs):
+        """
+        Run the plan on inputs and return its output records
+        """
+        outputs = [None] * len(self.steps)
+        for i, (graph, params, consumers) in enumerate(self.steps):
+            output = graph(**{k: outputs[j].pop() for k, j in params}, **inputs)
+            outputs[i] = Tee(output, consumers, self.buffer_size).iterators if consumers > 1 else [output]
+        return list(outputs[self.output].pop())
+
+
+def stage_head(graph):
+    """
+    Graph whose output a fused or batched stage maps, or the graph itself
+    """
+    if isinstance(graph, (FuseMe, BatchMe)) and graph.graph is not None:
+        return graph.graph
+    return graph
+
+
+def graph_label(graph):
+    for name in ('mapper', 'reducer', 'aggregator', 'joiner'):
+        operation = getattr(graph, name, None)
+        if operation is not None:
+            return "{}({})".format(graph.__class__.__name__, operation.__class__.__name__)
+    return graph.__class__.__name__
+
+
+def instrument(graph, profiler, stats):
+    """
+    Copy of graph with user operations timed by profiler
+    """
+    if isinstance(graph, (FuseMe, BatchMe)):
+        head = None if graph.graph is None else instrument(graph.graph, profiler, stats)
+        mappers = [profiler.timed(m, stats) for m in graph.mappers]
+        return FuseMe(head, mappers) if isinstance(graph, FuseMe) else BatchMe(head, mappers, graph.batch_size)
+
+    graph = copy(graph)
+    for name in ('mapper', 'reducer', 'aggregator', 'joiner', 'parser'):
+        if hasattr(graph, name):
+            setattr(graph, name, profiler.timed(getattr(graph, name), stats))
+    return graph
+
+
+class CodePickler(pickle.Pickler):
+    """
+    Pickler collecting classes of pickled objects and functions pickled by name
+    """
+    def __init__(self, file):
+        pickle.Pickler.__init__(self, file, pickle.HIGHEST_PROTOCOL)
+        self.code = {}
+
+    def reducer_override(self, obj):
+        self.code[obj if isinstance(obj, (type, types.FunctionType)) else type(obj)] = None
+        return NotImplemented
+
+
+def code_digest(code, digest):
+    digest.update(code.co_code)
+    digest.update(repr(code.co_names).encode())
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            code_digest(const, digest)
+        elif isinstance(const, frozenset):
+            digest.update(repr(sorted(map(repr, const))).encode())
+        else:
+            digest.update(repr(const).encode())
+
+
+def graph_fingerprint(graph):
+    """
+    Pickled graph and bytecode of classes and functions it's made of, so that
+    results cached under it are recomputed once code of operations changes.
+    None if graph can't be pickled.
+    """
+    f = io.BytesIO()
+    pickler = CodePickler(f)
+    try:
+        pickler.dump(graph)
+    except (pickle.PicklingError, AttributeError, TypeError):
+        return None
+    digest = hashlib.sha1(f.getvalue())
+    for obj in pickler.code:
+        classes = obj.__mro__ if isinstance(obj, type) else ()
+        functions = [obj] if isinstance(obj, types.FunctionType) else []
+        for klass in classes:
+            for name, value in sorted(vars(klass).items()):
+                if isinstance(value, (staticmethod, classmethod)):
+                    value = value.__func__
+                if isinstance(value, property):
+                    functions.extend(f for f in (value.fget, value.fset, value.fdel) if f is not None)
+                elif isinstance(value, types.FunctionType):
+                    functions.append(value)
+        for function in functions:
+            code_digest(function.__code__, digest)
+    return digest.digest()
+
+
+def lineage_key(path_node, inputs, memo=None):
+    """
+    Hex digest of operators of the subgraph ending at path_node, their code and
+    data they read, None if some operator can't be pickled or some input
+    fingerprinted
+    """
+    if memo is None:
+        memo = {}
+    if path_node in memo:
+        return memo[path_node]
+
+    graph = path_node.graph
+    digest = hashlib.sha1()
+    fingerprint = b'CacheMe' if isinstance(graph, CacheMe) else graph_fingerprint(graph)
+    if fingerprint is None:
+        digest = None
+    else:
+        digest.update(fingerprint)
+
+    source = graph.input_fingerprint(**inputs) if digest is not None else None
+    if source is None:
+        digest = None
+    else:
+        digest.update(source)
+        for name in sorted(path_node.params):
+            key = lineage_key(path_node.params[name], inputs, memo)
+            if key is None:
+                digest = None
+                break
+            digest.update("{}={};".format(name, key).encode())
+
+    memo[path_node] = None if digest is None else digest.hexdigest()
+    return memo[path_node]
+
+
 def dfs_run(start_node, visited):
     q = list()
     q.append(start_node)
@@ -154,114 +1396,175 @@ def dfs_run(start_node, visited):
 
 
 class ParametrizedGraph:
-    def __init__(self, params, graph):
+    def __init__(self, params, graph, previous=None):
         self.params = params
         self.graph = graph
-        self.output = None
+        self.previous = previous
 
     @property
     def inputs(self):
         return self.params.values()
 
-    def run(self, **kwargs):
-        if not self.output:
-            params = {k: v.run(**kwargs) for k, v in self.params.items()}
-            self.output = list(self.graph(**params, **kwargs))
-
-        return self.output
-
     @property
     def name(self):
         return self.graph.__class__.__name__
 
 
 class FireMR:
-    def __init__(self):
-        self.graphs = []
-
-    def read_from_file(self, filename, parser):
-        graph = ReadMe(filename, parser)
-        m = FireMR()
-        m.graphs = copy(self.graphs)
-        m.graphs.append(ParametrizedGraph({}, graph))
-        return m
-
-    def read_from_iter(self, it):
-        graph = ReadIterMe(it)
-        m = FireMR()
-        m.graphs = copy(self.graphs)
-        m.graphs.append(ParametrizedGraph({}, graph))
-        return m
+    """
+    Graph of operations ending at tail, the last graph added by builders.
+    Every builder returns a new FireMR linked to the tail of this one, so
+    building a graph of n operations takes O(n). Graphs are immutable, their
+    compiled plans are cached.
+    """
+    def __init__(self, tail=None):
+        self.tail = tail
+        self.compiled = {}
+
+    def then(self, params, graph):
+        """
+        New FireMR with graph reading params added after the tail
+        """
+        if None in params.values():
+            raise ValueError("{} has no input graph".format(graph.__class__.__name__))
+        return FireMR(ParametrizedGraph(params, graph, self.tail))
+
+    def read_from_file(self, filename, parser, workers=None, chunk_size=READ_CHUNK_SIZE, ordered=True,
+                       buffer_size=READ_BUFFER_SIZE, schema=None, encoding=None):
+        return self.then({}, ReadMe(filename, parser, workers, chunk_size, ordered, buffer_size, schema, encoding))
+
+    def read_from_iter(self, it, schema=None):
+        """
+        Read records passed to run as keyword argument it. With schema they
+        are read as compact rows of lib.records: schema is a Schema, a list of
+        columns or True to infer schemas from the records.
+        """
+        return self.then({}, ReadIterMe(it, schema))
+
+    def read_from_async_iter(self, it, schema=None):
+        return self.then({}, AsyncReadIterMe(it, schema))
+
+    def write_async(self, sink, queue_size=AIO_QUEUE_SIZE):
+        return self.then({"records": self.tail}, AsyncSaveMe(sink, queue_size))
 
     def save(self, buffer):
-        graph = SaveMe(buffer)
-        m = FireMR()
-        m.graphs = copy(self.graphs)
-        m.graphs.append(ParametrizedGraph({"records": m.graphs[-1]}, graph))
-        return m
-
-    def map(self, mapper):
-        graph = MapMe(mapper)
-        m = FireMR()
-        m.graphs = copy(self.graphs)
-        m.graphs.append(ParametrizedGraph({"records": m.graphs[-1]}, graph))
-        return m
-
-    def sort(self, keys):
-        graph = SortMe(keys)
-        m = FireMR()
-        m.graphs = copy(self.graphs)
-        m.graphs.append(ParametrizedGraph({"records": m.graphs[-1]}, graph))
-        return m
-
-    def aggregate(self, aggregator, keys):
-        graph = AggregateMe(aggregator, keys)
-        m = FireMR()
-        m.graphs = copy(self.graphs)
-        m.graphs.append(ParametrizedGraph({"records": m.graphs[-1]}, graph))
-        return m
-
-    def reduce(self, reducer, keys):
-        graph = ReduceMe(reducer, keys)
-        m = FireMR()
-        m.graphs = copy(self.graphs)
-        m.graphs.append(ParametrizedGraph({"records": m.graphs[-1]}, graph))
-        return m
-
-    def join(self, joiner, join_graph, keys):
-        graph = JoinMe(joiner, keys)
-        m = FireMR()
-        m.graphs = copy(self.graphs)
-        m.graphs.append(ParametrizedGraph({
-            "first_records": m.graphs[-1],
-            "second_records": join_graph.graphs[-1]
-        }, graph))
-        return m
+        return self.then({"records": self.tail}, SaveMe(buffer))
+
+    def map(self, mapper, workers=None, chunk_size=MAP_CHUNK_SIZE, ordered=True):
+        return self.then({"records": self.tail}, MapMe(mapper, workers, chunk_size, ordered))
+
+    def sort(self, keys, memory_limit=None, limit=None):
+        return self.then({"records": self.tail}, SortMe(keys, memory_limit, limit))
+
+    def aggregate(self, aggregator, keys, partitions=None, strategy='sort', sort_output=False):
+        if isinstance(aggregator, (list, tuple)):
+            aggregator = MultiAggregator(aggregator)
+        return self.then({"records": self.tail}, AggregateMe(aggregator, keys, partitions, strategy, sort_output))
+
+    def cache(self, cache):
+        if isinstance(cache, str):
+            cache = ResultCache(cache)
+        return self.then({"records": self.tail}, CacheMe(cache))
+
+    def top_k(self, column, n, keys):
+        return self.then({"records": self.tail}, TopKMe(column, n, keys))
+
+    def reduce(self, reducer, keys, partitions=None):
+        return self.then({"records": self.tail}, ReduceMe(reducer, keys, partitions))
+
+    def join(self, joiner, join_graph, keys, strategy='merge'):
+        return self.then({
+            "first_records": self.tail,
+            "second_records": join_graph.tail
+        }, JoinMe(joiner, keys, strategy))
 
     def write(self, stream):
-        graph = SaveMe(stream)
-        m = FireMR()
-        m.graphs = copy(self.graphs)
-        m.graphs.append(ParametrizedGraph({"records": m.graphs[-1]}, graph))
-        return m
+        return self.then({"records": self.tail}, SaveMe(stream))
 
     def get_path(self):
+        graphs = []
+        graph = self.tail
+        while graph is not None:
+            graphs.append(graph)
+            graph = graph.previous
+
         visited = set()
         path = []
-        for graph in self.graphs:
+        for graph in reversed(graphs):
             if graph not in visited:
                 path.extend(dfs_run(graph, visited))
         return path
 
-    def run(self, verbose=True, **kwargs):
-        path = self.get_path()
+    def compile(self, batch_size=None, buffer_size=TEE_BUFFER_SIZE):
+        """
+        Plan of the graph ready to run many times, see CompiledPlan. It's
+        built once for every batch_size and buffer_size and cached.
+        """
+        compiled = self.compiled.get((batch_size, buffer_size))
+        if compiled is None:
+            compiled = self.compiled[batch_size, buffer_size] = CompiledPlan(
+                self.get_path(), batch_size, buffer_size)
+        return compiled
+
+    def run(self, verbose=True, buffer_size=TEE_BUFFER_SIZE, batch_size=None, profile=False, workers=None,
+            executor='process', cluster=None, **kwargs):
+        """
+        Run the graph and return its output records, or (records, RunStats)
+        with per node statistics if profile is set. If workers is set,
+        independent branches run concurrently on a pool of workers of executor
+        type ('process' or 'thread'). If cluster is set, the graph runs on
+        workers of lib.cluster.Cluster. Cluster runs don't keep the order of
+        records with equal keys: groups get them in another order than local
+        runs, so FirstReducer, top_k among tied records and float sums may
+        give other results, and so does everything ordered by them.
+        """
+        compiled = self.compile(batch_size, buffer_size)
         if verbose:
-            logger.error("Execution path: {}".format(", ".join(p.name for p in path)))
+            logger.info(compiled.description)
+
+        if cluster is not None:
+            if profile or workers:
+                raise ValueError("Profiling and workers are not supported on cluster")
+            return cluster.execute(compiled.plan, **kwargs)
 
-        for p in self.get_path():
-            p.output=None
+        if workers:
+            if profile:
+                raise ValueError("Profiling is not supported with workers")
+            from lib.scheduler import Scheduler  # lib.scheduler imports this module
+            scheduler = Scheduler(compiled.plan, workers, executor)
+            if verbose:
+                logger.info(scheduler.describe())
+            return scheduler.run(**kwargs)
 
-        for p in self.get_path():
-            p.run(**kwargs)
+        if not profile:
+            return compiled.execute(**kwargs)
+
+        profiler = Profiler()
+        result = list(compiled.plan.stream(buffer_size, profiler, **kwargs))
+        stats = profiler.stats()
+        if verbose:
+            logger.info(stats.describe())
+        return result, stats
+
+    async def run_async(self, verbose=True, buffer_size=TEE_BUFFER_SIZE, batch_size=None,
+                        queue_size=AIO_QUEUE_SIZE, **kwargs):
+        """
+        Run the graph in a worker thread without blocking the event loop and
+        return its output records. Async iterable inputs are consumed on the
+        loop as the graph reads them, at most queue_size records ahead of it.
+        """
+        loop = asyncio.get_running_loop()
+        compiled = self.compile(batch_size, buffer_size)
+        if verbose:
+            logger.info(compiled.description)
 
-        return list(p.output)
+        sources = {k: AsyncSource(v, loop, queue_size) for k, v in kwargs.items() if hasattr(v, '__aiter__')}
+        pumps = [asyncio.ensure_future(source.pump()) for source in sources.values()]
+        kwargs.update(sources)
+        context = contextvars.copy_context()
+        context.run(RUNNING_LOOP.set, loop)
+        try:
+            return await loop.run_in_executor(None, lambda: context.run(compiled.execute, **kwargs))
+        finally:
+            for pump in pumps:
+                pump.cancel()
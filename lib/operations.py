@@ -1,15 +1,90 @@
 import string
 import heapq
 import math
-from datetime import datetime, timedelta
+import sys
+from datetime import timedelta
 from abc import abstractmethod
-from copy import deepcopy
 from math import sin, cos, sqrt, atan2, radians
 
+from lib.records import Row
+from lib.timestamps import parse_timestamp, format_timestamp
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+PUNCTUATION = str.maketrans('', '', string.punctuation)
+EXACT_INT = 2 ** 53
+
+
+def order_prefix(order, columns):
+    """
+    Longest prefix of sort order which doesn't contain any of columns
+    :type order: tuple[str]
+    :type columns: list[str]
+    :rtype: tuple[str]
+    """
+    prefix = []
+    for k in order:
+        if k in columns:
+            break
+        prefix.append(k)
+    return tuple(prefix)
+
+
+def project(r, columns):
+    """
+    Record of only given columns of r: a row of cached projected schema for
+    rows, a new dict otherwise
+    :type columns: list[str]
+    """
+    if isinstance(r, Row):
+        return r.project(columns)
+    return {k: r[k] for k in columns}
+
+
+def values_of(column):
+    return column.tolist() if hasattr(column, 'tolist') else column
+
+
+def numbers(column):
+    """
+    Column batch as numpy array if numpy computes on it exactly as Python
+    does on its values: all floats or all ints below EXACT_INT, else None
+    """
+    if isinstance(column, list):
+        types = set(map(type, column))
+        if types != {float} and types != {int}:
+            return None
+    array = np.asarray(column)
+    if array.dtype.kind == 'f':
+        return array
+    if array.dtype.kind in 'iu' and (not array.size or np.abs(array).max() < EXACT_INT):
+        return array
+    return None
+
+
+def map_rows(mapper, columns):
+    """
+    Apply mapper to every row of column batch, for batches it can't compute
+    on columns exactly as on rows
+    """
+    names = list(columns)
+    values = [values_of(v) for v in columns.values()]
+    rows = [m for row in zip(*values) for m in mapper(dict(zip(names, row)))]
+    if not rows:
+        return {k: [] for k in names}
+    return {k: [r[k] for r in rows] for k in rows[0]}
+
 
 class Mapper(object):
     """
     base class for mapping operations
+
+    Rows passed to mappers, reducers and joiners are owned by them: engine
+    copies rows shared between branches, so operations may set columns of a
+    row in place and yield it. Column values themselves must not be mutated.
     """
     @abstractmethod
     def __call__(self, r):
@@ -19,11 +94,26 @@ class Mapper(object):
         """
         pass
 
+    def kept_order(self, order):
+        """
+        :param order: columns input rows are sorted by
+        :type order: tuple[str]
+        :return: prefix of order output rows are still sorted by
+        :rtype: tuple[str]
+        """
+        return ()
+
 
 class Reducer(object):
     """
     base class for reduce operations
+
+    Combinable reducers yield the same records for a group as for records
+    they yielded for parts of the group, taken in the same order. This lets
+    engine reduce parts of groups before sorting or shuffling rows.
     """
+    combinable = False
+
     @abstractmethod
     def __call__(self, records):
         """
@@ -32,11 +122,28 @@ class Reducer(object):
         """
         pass
 
+    def kept_order(self, order, keys):
+        """
+        :param order: columns input rows are sorted by
+        :type order: tuple[str]
+        :param keys: columns rows are grouped by
+        :type keys: list[str]
+        :return: prefix of order output rows are still sorted by
+        :rtype: tuple[str]
+        """
+        return ()
+
 
 class Aggregator(object):
     """
     base class for folding operations
+
+    Combinable aggregators can fold rows into partial states separately and
+    merge partial states afterwards, which lets engine pre-aggregate rows
+    before sorting or shuffling them. They set combinable and implement merge.
     """
+    combinable = False
+
     @abstractmethod
     def __call__(self, r, state):
         """
@@ -47,6 +154,16 @@ class Aggregator(object):
         """
         pass
 
+    @abstractmethod
+    def merge(self, state, partial):
+        """
+        :param state: mutable aggregation state
+        :type state: dict[str,object]
+        :param partial: state of the same key aggregated separately
+        :type partial: dict[str,object]
+        """
+        pass
+
 
 class Joiner(object):
     """
@@ -71,15 +188,16 @@ class FilterPunctuation(Mapper):
     def __init__(self, column):
         self.column = column
 
+    def kept_order(self, order):
+        return order_prefix(order, [self.column])
+
     @staticmethod
     def _filter_punctuation(txt):
-        p = set(string.punctuation)
-        return "".join([c for c in txt if c not in p])
+        return txt.translate(PUNCTUATION)
 
     def __call__(self, r):
-        new_r = deepcopy(r)
-        new_r[self.column] = self._filter_punctuation(r[self.column])
-        yield new_r
+        r[self.column] = self._filter_punctuation(r[self.column])
+        yield r
 
 
 class LowerCase(Mapper):
@@ -93,14 +211,16 @@ class LowerCase(Mapper):
         """
         self.column = column
 
+    def kept_order(self, order):
+        return order_prefix(order, [self.column])
+
     @staticmethod
     def _lower_case(txt):
         return txt.lower()
 
     def __call__(self, r):
-        new_r = deepcopy(r)
-        new_r[self.column] = self._lower_case(r[self.column])
-        yield new_r
+        r[self.column] = self._lower_case(r[self.column])
+        yield r
 
 
 class Grep(Mapper):
@@ -117,6 +237,9 @@ class Grep(Mapper):
         self.column = column
         self.condition = condition
 
+    def kept_order(self, order):
+        return order
+
     def __call__(self, r):
         if self.condition(r[self.column]):
             yield r
@@ -136,22 +259,67 @@ class Split(Mapper):
         self.column = column
         self.separator = separator
 
+    def kept_order(self, order):
+        return order_prefix(order, [self.column])
+
     @staticmethod
     def _split(txt, separator):
         for t in txt.split(separator):
             yield t
 
     def __call__(self, r):
-        for t in self._split(r[self.column], self.separator):
-            new_r = deepcopy(r)
+        tokens = list(self._split(r[self.column], self.separator))
+        for t in tokens[:-1]:
+            new_r = r.copy()
             new_r[self.column] = t
             yield new_r
+        if tokens:
+            r[self.column] = tokens[-1]
+            yield r
+
+
+class Tokenize(Mapper):
+    """
+    Remove punctuation, lower case and split text column into one row per token.
+    Same as FilterPunctuation, LowerCase and Split in one pass.
+    """
+    def __init__(self, column, columns=None):
+        """
+        :param column: name of column with text
+        :type column: str
+        :param columns: names of other columns to keep in token rows, all if None
+        :type columns: list[str]
+        """
+        self.column = column
+        self.columns = columns
+
+    def kept_order(self, order):
+        if self.columns is None:
+            return order_prefix(order, [self.column])
+        return order_prefix(order, [self.column] + [k for k in order if k not in self.columns])
+
+    def __call__(self, r):
+        tokens = r[self.column].translate(PUNCTUATION).lower().split()
+        if self.columns is not None:
+            r = project(r, self.columns)
+
+        column = self.column
+        for t in tokens[:-1]:
+            new_r = r.copy()
+            new_r[column] = sys.intern(t)
+            yield new_r
+        if tokens:
+            r[column] = sys.intern(tokens[-1])
+            yield r
 
 
 class Dummy(Mapper):
     """
     Pass row as is
     """
+    def kept_order(self, order):
+        return order
+
     def __call__(self, r):
         yield r
 
@@ -160,6 +328,8 @@ class Sum(Aggregator):
     """
     Add values passed to __call__ and save it in state
     """
+    combinable = True
+
     def __init__(self, column):
         """
         :param column: name of column
@@ -173,11 +343,31 @@ class Sum(Aggregator):
         state[self.column] += r[self.column]
         return state
 
+    def merge(self, state, partial):
+        state[self.column] = state.get(self.column, 0) + partial[self.column]
+        return state
+
+    def batch(self, columns, state):
+        """
+        Add all values of column batch one by one, as rows are added
+        """
+        total = state.get(self.column, 0)
+        values = numbers(columns[self.column])
+        if values is not None and values.dtype.kind == 'f':
+            total = np.cumsum(np.concatenate(([total], values)))[-1].item()
+        else:
+            for v in values_of(columns[self.column]):
+                total += v
+        state[self.column] = total
+        return state
+
 
 class Count(Aggregator):
     """
     Count values passed to __call__ and save it in state
     """
+    combinable = True
+
     def __init__(self, column):
         """
         :param column: name of column
@@ -191,6 +381,60 @@ class Count(Aggregator):
         state[self.column] += 1
         return state
 
+    def merge(self, state, partial):
+        state[self.column] = state.get(self.column, 0) + partial[self.column]
+        return state
+
+    def batch(self, columns, state):
+        """
+        Count rows of column batch
+        """
+        state[self.column] = state.get(self.column, 0) + len(next(iter(columns.values())))
+        return state
+
+
+class MultiAggregator(Aggregator):
+    """
+    Fold rows with several aggregators into one state in one pass
+    """
+    def __init__(self, aggregators):
+        """
+        :param aggregators: aggregators saving different columns
+        :type aggregators: list[Aggregator]
+        """
+        self.aggregators = list(aggregators)
+        self.combinable = all(a.combinable for a in self.aggregators)
+        if all(hasattr(a, 'batch') for a in self.aggregators):
+            self.batch = self._batch
+
+    def __call__(self, r, state):
+        for a in self.aggregators:
+            state = a(r, state)
+        return state
+
+    def merge(self, state, partial):
+        for a in self.aggregators:
+            state = a.merge(state, partial)
+        return state
+
+    def _batch(self, columns, state):
+        for a in self.aggregators:
+            state = a.batch(columns, state)
+        return state
+
+
+def aggregated_columns(aggregator):
+    """
+    Columns aggregator saves in state, None if they are unknown
+    :type aggregator: Aggregator
+    :rtype: list[str] | None
+    """
+    if isinstance(aggregator, MultiAggregator):
+        columns = [aggregated_columns(a) for a in aggregator.aggregators]
+        return None if None in columns else [c for cs in columns for c in cs]
+    column = getattr(aggregator, 'column', None)
+    return None if column is None else [column]
+
 
 class Velocity(Mapper):
     """
@@ -209,16 +453,32 @@ class Velocity(Mapper):
         self.column_time = column_time
         self.column_result = column_result
 
+    def kept_order(self, order):
+        return order_prefix(order, [self.column_result])
+
     def __call__(self, r):
-        new_r = deepcopy(r)
-        new_r[self.column_result] = r[self.column_distance] / r[self.column_time] * 60 * 60 / 1000 if r[self.column_time] else None
-        yield new_r
+        r[self.column_result] = r[self.column_distance] / r[self.column_time] * 60 * 60 / 1000 if r[self.column_time] else None
+        yield r
+
+    def batch(self, columns):
+        distance = numbers(columns[self.column_distance])
+        time = numbers(columns[self.column_time])
+        if distance is None or time is None:
+            return map_rows(self, columns)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            columns[self.column_result] = np.where(time != 0, distance / time * 60 * 60 / 1000, None)
+        return columns
 
 
 class FirstReducer(Reducer):
     """
     Yield only first record from records
     """
+    combinable = True
+
+    def kept_order(self, order, keys):
+        return order
+
     def __call__(self, records):
         for r in records:
             yield r
@@ -246,6 +506,9 @@ class DistanceFromLonLat(Mapper):
         self.column_end = column_end
         self.column_result = column_result
 
+    def kept_order(self, order):
+        return order_prefix(order, [self.column_result])
+
     def __call__(self, r):
 
         lon1, lat1 = [radians(x) for x in r[self.column_start]]
@@ -257,9 +520,21 @@ class DistanceFromLonLat(Mapper):
         a = sin(dlat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(dlon / 2) ** 2
         c = 2 * atan2(sqrt(a), sqrt(1 - a))
 
-        new_r = deepcopy(r)
-        new_r[self.column_result] = self.R * c
-        yield new_r
+        r[self.column_result] = self.R * c
+        yield r
+
+    def batch(self, columns):
+        start = np.radians(np.asarray(columns[self.column_start], dtype=float).reshape(-1, 2))
+        end = np.radians(np.asarray(columns[self.column_end], dtype=float).reshape(-1, 2))
+
+        dlon = end[:, 0] - start[:, 0]
+        dlat = end[:, 1] - start[:, 1]
+
+        a = np.sin(dlat / 2) ** 2 + np.cos(start[:, 1]) * np.cos(end[:, 1]) * np.sin(dlon / 2) ** 2
+        c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+        columns[self.column_result] = self.R * c
+        return columns
 
 
 class Idf(Mapper):
@@ -276,10 +551,20 @@ class Idf(Mapper):
         self.column_total_docs = column_total_docs
         self.column_idf = column_idf
 
+    def kept_order(self, order):
+        return order_prefix(order, [self.column_idf])
+
     def __call__(self, r):
-        new_r = deepcopy(r)
-        new_r[self.column_idf] = math.log(r[self.column_total_docs]) - math.log(r[self.column_docs_with_words])
-        yield new_r
+        r[self.column_idf] = math.log(r[self.column_total_docs]) - math.log(r[self.column_docs_with_words])
+        yield r
+
+    def batch(self, columns):
+        """
+        Logarithms are taken by math.log, np.log may differ from it in the last bit
+        """
+        columns[self.column_idf] = [math.log(total) - math.log(docs) for total, docs in zip(
+            values_of(columns[self.column_total_docs]), values_of(columns[self.column_docs_with_words]))]
+        return columns
 
 
 class Tf(Reducer):
@@ -296,6 +581,9 @@ class Tf(Reducer):
         self.column_words = column_words
         self.column_tf = column_tf
 
+    def kept_order(self, order, keys):
+        return order_prefix(order, [k for k in order if k not in keys] + [self.column_words, self.column_tf])
+
     def __call__(self, records):
         words_dict = {}
         last_record = {}
@@ -308,7 +596,7 @@ class Tf(Reducer):
 
         total = sum(words_dict.values())
         for k, v in words_dict.items():
-            new_r = deepcopy(last_record)
+            new_r = last_record.copy()
             new_r[self.column_words] = k
             new_r[self.column_tf] = v/total
             yield new_r
@@ -328,18 +616,37 @@ class Product(Mapper):
         self.columns_arguments = columns_arguments
         self.column_result = column_result
 
+    def kept_order(self, order):
+        return order_prefix(order, [self.column_result])
+
     def __call__(self, r):
-        new_r = deepcopy(r)
-        new_r[self.column_result] = 1
+        product = 1
         for arg in self.columns_arguments:
-            new_r[self.column_result] *= r[arg]
-        yield new_r
+            product *= r[arg]
+        r[self.column_result] = product
+        yield r
+
+    def batch(self, columns):
+        arrays = [numbers(columns[arg]) for arg in self.columns_arguments]
+        if not arrays or any(a is None for a in arrays):
+            return map_rows(self, columns)
+        product = 1
+        for a in arrays:
+            product = product * a
+        if product.dtype.kind in 'iu':
+            bound = np.prod([np.abs(a).astype(float) for a in arrays], axis=0)
+            if bound.size and bound.max() >= 2 ** 62:
+                return map_rows(self, columns)
+        columns[self.column_result] = product
+        return columns
 
 
 class Max(Reducer):
     """
     Calculate top N by value
     """
+    combinable = True
+
     def __init__(self, column_max, n):
         """
         :param column_max: column names to find max
@@ -350,6 +657,9 @@ class Max(Reducer):
         self.column_max = column_max
         self.n = n
 
+    def kept_order(self, order, keys):
+        return order_prefix(order, [k for k in order if k not in keys])
+
     def __call__(self, records):
         for r in heapq.nlargest(self.n, records, key=lambda x: x[self.column_max]):
             yield r
@@ -372,26 +682,31 @@ class DiffTime(Mapper):
         self.column_b = column_b
         self.column_result = column_result
 
+    def kept_order(self, order):
+        return order_prefix(order, [self.column_result])
+
     def __call__(self, r):
-        da = datetime.strptime(r[self.column_a], "%Y%m%dT%H%M%S.%f")
-        db = datetime.strptime(r[self.column_b], "%Y%m%dT%H%M%S.%f")
+        da = parse_timestamp(r[self.column_a])
+        db = parse_timestamp(r[self.column_b])
 
-        new_r = deepcopy(r)
-        new_r[self.column_result] = (db - da).total_seconds()
-        yield new_r
+        r[self.column_result] = (db - da).total_seconds()
+        yield r
 
 
 class WeekHourSplit(Mapper):
     """
     Split yandex maps special log by week-hour and set time interval on each of them
     """
+
+    WEEKDAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+
     def __init__(self, column_start, column_end, hour_column='hour', week_column='weekday',
                  hour_time_column='hour_time', total_time_column="total_time"):
         """
 
-        :param column_start: name of column with start time in format self.dt_template_*. Replaced by interval start
+        :param column_start: name of column with start time in format %Y%m%dT%H%M%S[.%f]. Replaced by interval start
         :type column_start: str
-        :param column_end: name of column with end time in format self.dt_template_*. Replaced by interval end
+        :param column_end: name of column with end time in format %Y%m%dT%H%M%S[.%f]. Replaced by interval end
         :type column_end: str
         :param hour_column: name of column to save integer hour
         :type hour_column: str
@@ -408,38 +723,67 @@ class WeekHourSplit(Mapper):
         self.week_column = week_column
         self.hour_time_column = hour_time_column
         self.total_time_column = total_time_column
-        self.dt_template = "%Y%m%dT%H%M%S.%f"
-        self.dt_template_backup = "%Y%m%dT%H%M%S"
-
-    def __call__(self, r):
 
-        if '.' in r[self.column_start]:
-            da = datetime.strptime(r[self.column_start], self.dt_template)
-        else:
-            da = datetime.strptime(r[self.column_start], self.dt_template_backup)
+    def kept_order(self, order):
+        return order_prefix(order, [self.column_start, self.column_end, self.hour_column, self.week_column,
+                                    self.hour_time_column, self.total_time_column])
 
-        if '.' in r[self.column_end]:
-            db = datetime.strptime(r[self.column_end], self.dt_template)
-        else:
-            db = datetime.strptime(r[self.column_end], self.dt_template_backup)
+    def __call__(self, r):
+        da = parse_timestamp(r[self.column_start])
+        db = parse_timestamp(r[self.column_end])
 
         total_time = (db - da).total_seconds()
         step_da = da
         step_db = min((step_da + timedelta(hours=1)).replace(minute=0, second=0, microsecond=0), db)
         while step_da < db:
-            new_r = deepcopy(r)
+            new_r = r if step_db == db else r.copy()
             new_r[self.hour_column] = step_da.hour
-            new_r[self.week_column] = step_da.strftime('%a')
+            new_r[self.week_column] = self.WEEKDAYS[step_da.weekday()]
             new_r[self.hour_time_column] = (step_db - step_da).total_seconds()
             new_r[self.total_time_column] = total_time
 
-            new_r[self.column_start] = step_da.strftime(self.dt_template)
-            new_r[self.column_end] = step_db.strftime(self.dt_template)
+            new_r[self.column_start] = format_timestamp(step_da)
+            new_r[self.column_end] = format_timestamp(step_db)
 
             yield new_r
             step_da = step_db
             step_db = min((step_da + timedelta(hours=1)).replace(minute=0, second=0, microsecond=0), db)
 
+    @staticmethod
+    def _to_datetime64(values):
+        return np.array(['{}-{}-{}T{}:{}:{}'.format(v[:4], v[4:6], v[6:8], v[9:11], v[11:13], v[13:])
+                         for v in values], dtype='datetime64[us]')
+
+    @staticmethod
+    def _format_datetime64(values):
+        return [v.replace('-', '').replace(':', '') for v in np.datetime_as_string(values, unit='us').tolist()]
+
+    def batch(self, columns):
+        da = self._to_datetime64(columns[self.column_start])
+        db = self._to_datetime64(columns[self.column_end])
+        microsecond = np.timedelta64(1, 'us')
+        hour = np.timedelta64(1, 'h')
+
+        first_hour = da.astype('datetime64[h]')
+        counts = np.where(db > da, (db - microsecond).astype('datetime64[h]') - first_hour + 1, 0).astype(int)
+        index = np.repeat(np.arange(len(da)), counts)
+        step = np.arange(len(index)) - np.repeat(np.cumsum(counts) - counts, counts)
+
+        hours = first_hour[index] + step * hour
+        step_da = np.where(step == 0, da[index], hours)
+        step_db = np.minimum(hours + hour, db[index])
+
+        result = {}
+        for k, v in columns.items():
+            result[k] = v[index] if isinstance(v, np.ndarray) else [v[i] for i in index.tolist()]
+        result[self.hour_column] = (hours.astype('int64') % 24).tolist()
+        result[self.week_column] = [self.WEEKDAYS[d] for d in ((hours.astype('datetime64[D]').astype('int64') + 3) % 7).tolist()]
+        result[self.hour_time_column] = (step_db - step_da) / microsecond / 10 ** 6
+        result[self.total_time_column] = ((db - da) / microsecond / 10 ** 6)[index]
+        result[self.column_start] = self._format_datetime64(step_da)
+        result[self.column_end] = self._format_datetime64(step_db)
+        return result
+
 
 class Divide(Mapper):
     """
@@ -455,10 +799,21 @@ class Divide(Mapper):
         self.column_denominator = column_denominator
         self.column_result = column_result
 
+    def kept_order(self, order):
+        return order_prefix(order, [self.column_result])
+
     def __call__(self, r):
-        new_r = deepcopy(r)
-        new_r[self.column_result] = r[self.column_numerator] / r[self.column_denominator] if r[self.column_denominator] else None
-        yield new_r
+        r[self.column_result] = r[self.column_numerator] / r[self.column_denominator] if r[self.column_denominator] else None
+        yield r
+
+    def batch(self, columns):
+        numerator = numbers(columns[self.column_numerator])
+        denominator = numbers(columns[self.column_denominator])
+        if numerator is None or denominator is None:
+            return map_rows(self, columns)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            columns[self.column_result] = np.where(denominator != 0, numerator / denominator, None)
+        return columns
 
 
 class InnerJoiner(Joiner):
@@ -470,7 +825,7 @@ class InnerJoiner(Joiner):
         cache = list(records_b)
         for a in records_a:
             for b in cache:
-                new_r = deepcopy(a)
+                new_r = a.copy()
                 new_r.update(b)
                 yield new_r
 
@@ -494,7 +849,7 @@ class OuterJoiner(Joiner):
 
         for a in cache_a:
             for b in cache_b:
-                new_r = deepcopy(a)
+                new_r = a.copy()
                 new_r.update(b)
                 yield new_r
 
@@ -509,7 +864,7 @@ class LeftJoiner(Joiner):
 
         for a in records_a:
             for b in cache_b:
-                new_r = deepcopy(a)
+                new_r = a.copy()
                 new_r.update(b)
                 yield new_r
             if not cache_b:
@@ -526,7 +881,7 @@ class RightJoiner(Joiner):
 
         for b in records_b:
             for a in cache_a:
-                new_r = deepcopy(b)
+                new_r = b.copy()
                 new_r.update(a)
                 yield new_r
             if not cache_a:
@@ -543,5 +898,11 @@ class Cut(Mapper):
         """
         self.columns = columns
 
+    def kept_order(self, order):
+        return order_prefix(order, [k for k in order if k not in self.columns])
+
     def __call__(self, r):
-        yield {k: r[k] for k in self.columns}
+        yield project(r, self.columns)
+
+    def batch(self, columns):
+        return {k: columns[k] for k in self.columns}
@@ -0,0 +1,216 @@
+from functools import partial
+from time import perf_counter, process_time
+from types import GeneratorType
+
+import json
+import sys
+
+SIZE_SAMPLE = 100
+TIMED_METHODS = ('batch', 'merge')
+
+
+def record_size(r):
+    return sys.getsizeof(r) + sum(sys.getsizeof(v) for v in r.values())
+
+
+class NodeStats:
+    """
+    Run statistics of one plan node. Wall and CPU times include time spent
+    pulling records from inputs, self times don't, user time is the part of
+    self time spent inside mappers, reducers, aggregators, joiners and parsers.
+    """
+    def __init__(self, name, operations):
+        self.name = name
+        self.operations = operations
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.self_time = 0.0
+        self.self_cpu_time = 0.0
+        self.user_time = 0.0
+        self.records_in = 0
+        self.records_out = 0
+        self.sample_bytes = 0
+        self.first_start = None
+        self.last_end = None
+
+    @property
+    def output_bytes(self):
+        """
+        Estimated size of the output if it was materialized in memory
+        """
+        sampled = min(self.records_out, SIZE_SAMPLE)
+        return self.sample_bytes * self.records_out // sampled if sampled else 0
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'operations': self.operations,
+            'wall_time': self.wall_time,
+            'cpu_time': self.cpu_time,
+            'self_time': self.self_time,
+            'self_cpu_time': self.self_cpu_time,
+            'user_time': self.user_time,
+            'records_in': self.records_in,
+            'records_out': self.records_out,
+            'output_bytes': self.output_bytes,
+        }
+
+
+class RunStats:
+    """
+    Statistics of one run, nodes are in order of the execution plan
+    """
+    def __init__(self, nodes, wall_time, cpu_time):
+        self.nodes = nodes
+        self.wall_time = wall_time
+        self.cpu_time = cpu_time
+
+    def to_dict(self):
+        return {
+            'wall_time': self.wall_time,
+            'cpu_time': self.cpu_time,
+            'nodes': [node.to_dict() for node in self.nodes],
+        }
+
+    def to_json(self, filename=None):
+        """
+        Return statistics as JSON string, write it to filename if it's given
+        """
+        data = json.dumps(self.to_dict(), indent=2)
+        if filename is not None:
+            with open(filename, 'w') as f:
+                f.write(data)
+        return data
+
+    def to_chrome_trace(self, filename=None):
+        """
+        Return statistics as Chrome trace events (chrome://tracing, Perfetto),
+        every node is a thread spanning from its first to its last record
+        """
+        events = []
+        for i, node in enumerate(self.nodes):
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': i,
+                           'args': {'name': "{} {}".format(i, node.name)}})
+            if node.first_start is None:
+                continue
+            events.append({'name': node.name, 'cat': ",".join(node.operations), 'ph': 'X', 'pid': 0, 'tid': i,
+                           'ts': node.first_start * 1e6, 'dur': (node.last_end - node.first_start) * 1e6,
+                           'args': node.to_dict()})
+
+        trace = {'traceEvents': events, 'displayTimeUnit': 'ms'}
+        if filename is not None:
+            with open(filename, 'w') as f:
+                json.dump(trace, f)
+        return trace
+
+    def describe(self):
+        lines = ["Run took {:.3f}s wall, {:.3f}s CPU".format(self.wall_time, self.cpu_time)]
+        for node in self.nodes:
+            lines.append("{} [{}]: {:.3f}s self, {:.3f}s user, {} -> {} records, ~{} bytes".format(
+                node.name, ", ".join(node.operations), node.self_time, node.user_time,
+                node.records_in, node.records_out, node.output_bytes))
+        return "\n".join(lines)
+
+
+class Timed:
+    """
+    Operation proxy accounting time of its calls to user time of node stats
+    """
+    def __init__(self, operation, profiler, stats):
+        self.operation = operation
+        self.profiler = profiler
+        self.stats = stats
+
+    def __call__(self, *args):
+        return self.profiler.call(self.stats, self.operation, *args)
+
+    def __getattr__(self, name):
+        if name in ('operation', 'profiler', 'stats'):
+            raise AttributeError(name)
+        value = getattr(self.operation, name)
+        if name in TIMED_METHODS:
+            return partial(self.profiler.call, self.stats, value)
+        return value
+
+
+class Profiler:
+    """
+    Stack based accounting of time spent in plan nodes.
+
+    Nodes pull records from each other lazily, so every pull opens a frame
+    and time of a frame is subtracted from self time of the frame it's
+    nested in. User operation frames are transparent: pulls nested in them
+    are subtracted from the node calling the operation.
+    """
+    def __init__(self):
+        self.stack = []
+        self.nodes = []
+        self.start = perf_counter(), process_time()
+
+    def enter(self):
+        self.stack.append([0.0, 0.0])
+        return perf_counter(), process_time()
+
+    def exit(self, start, user=False):
+        end = perf_counter()
+        wall, cpu = end - start[0], process_time() - start[1]
+        children = self.stack.pop()
+        if self.stack:
+            parent = self.stack[-1]
+            parent[0] += children[0] if user else wall
+            parent[1] += children[1] if user else cpu
+        return end, wall, cpu, wall - children[0], cpu - children[1]
+
+    def call(self, stats, function, *args):
+        start = self.enter()
+        try:
+            result = function(*args)
+            if isinstance(result, GeneratorType):
+                result = list(result)
+        finally:
+            stats.user_time += self.exit(start, user=True)[3]
+        return result
+
+    def node_stats(self, name, operations):
+        stats = NodeStats(name, operations)
+        self.nodes.append(stats)
+        return stats
+
+    def timed(self, operation, stats):
+        return None if operation is None else Timed(operation, self, stats)
+
+    def records_in(self, stats, records):
+        for r in records:
+            stats.records_in += 1
+            yield r
+
+    def records_out(self, stats, graph, params, kwargs):
+        """
+        Call graph lazily and yield its output, accounting every pull to stats
+        """
+        records = None
+        while True:
+            start = self.enter()
+            if stats.first_start is None:
+                stats.first_start = start[0] - self.start[0]
+            try:
+                if records is None:
+                    records = iter(graph(**params, **kwargs))
+                r = next(records)
+            except StopIteration:
+                return
+            finally:
+                end, wall, cpu, self_wall, self_cpu = self.exit(start)
+                stats.last_end = end - self.start[0]
+                stats.wall_time += wall
+                stats.cpu_time += cpu
+                stats.self_time += self_wall
+                stats.self_cpu_time += self_cpu
+
+            stats.records_out += 1
+            if stats.records_out <= SIZE_SAMPLE:
+                stats.sample_bytes += record_size(r)
+            yield r
+
+    def stats(self):
+        return RunStats(self.nodes, perf_counter() - self.start[0], process_time() - self.start[1])
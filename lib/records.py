@@ -0,0 +1,228 @@
+"""
+Compact records of known columns.
+
+A Row keeps values of its columns in a list and shares the Schema mapping
+column names to positions with all rows of the same columns. It behaves as
+a mapping like the dict records it replaces, so operations work on both,
+but takes two to three times less memory. Rows are lists only to save the
+separate values object: use them through the mapping interface.
+"""
+from itertools import repeat
+from operator import itemgetter
+
+
+def key_getter(keys):
+    """
+    Compiled function returning tuple of values of keys of a record
+    :type keys: list[str]
+    """
+    keys = tuple(keys)
+    if not keys:
+        return lambda r: ()
+    if len(keys) == 1:
+        get = itemgetter(keys[0])
+        return lambda r: (get(r),)
+    return itemgetter(*keys)
+
+
+class Schema:
+    """
+    Ordered columns of rows. Schemas derived by adding, removing or keeping
+    columns are cached, so rows changed the same way share one schema.
+    """
+    def __init__(self, columns):
+        """
+        :type columns: list[str]
+        """
+        self.columns = tuple(columns)
+        self.index = {c: i for i, c in enumerate(self.columns)}
+        if len(self.index) != len(self.columns):
+            raise ValueError("Duplicate columns in schema: {}".format(", ".join(self.columns)))
+        self.values = key_getter(self.columns)
+        self.derived = {}
+        self.extensions = {}
+        self.projections = {}
+
+    def __reduce__(self):
+        return Schema, (self.columns,)
+
+    def __eq__(self, other):
+        return isinstance(other, Schema) and self.columns == other.columns
+
+    def __hash__(self):
+        return hash(self.columns)
+
+    def __repr__(self):
+        return "Schema({})".format(", ".join(self.columns))
+
+    def derive(self, change, columns):
+        schema = self.derived.get((change, columns))
+        if schema is None:
+            schema = self.derived[change, columns] = Schema(columns)
+        return schema
+
+    def extended(self, column):
+        schema = self.extensions.get(column)
+        if schema is None:
+            schema = self.extensions[column] = self.derive('+', self.columns + (column,))
+        return schema
+
+    def without(self, column):
+        return self.derive('-', tuple(c for c in self.columns if c != column))
+
+    def projection(self, columns):
+        """
+        Schema of given columns and their positions in this schema
+        """
+        columns = tuple(columns)
+        projection = self.projections.get(columns)
+        if projection is None:
+            projection = self.projections[columns] = (
+                self.derive('=', columns), [self.index[c] for c in columns])
+        return projection
+
+    def row(self, record):
+        """
+        Row of this schema with values of a record having exactly its columns
+        """
+        if len(record) != len(self.columns):
+            raise ValueError("Record columns {} don't match {}".format(", ".join(record), self))
+        try:
+            return Row(self, self.values(record))
+        except KeyError:
+            raise ValueError("Record columns {} don't match {}".format(", ".join(record), self))
+
+
+_get = list.__getitem__
+
+
+class Row(list):
+    """
+    Record of schema: a mapping of its columns to values kept in a list.
+    Setting a new column or deleting one switches the row to a derived schema.
+    """
+    __slots__ = ('schema',)
+
+    def __init__(self, schema, values):
+        list.__init__(self, values)
+        self.schema = schema
+
+    def __reduce__(self):
+        return Row, (self.schema, list(list.__iter__(self)))
+
+    def __getitem__(self, column):
+        return _get(self, self.schema.index[column])
+
+    def __setitem__(self, column, value):
+        schema = self.schema
+        i = schema.index.get(column)
+        if i is None:
+            self.schema = schema.extensions.get(column) or schema.extended(column)
+            list.append(self, value)
+        else:
+            list.__setitem__(self, i, value)
+
+    def __delitem__(self, column):
+        i = self.schema.index[column]
+        self.schema = self.schema.without(column)
+        list.__delitem__(self, i)
+
+    def __iter__(self):
+        return iter(self.schema.columns)
+
+    def __contains__(self, column):
+        return column in self.schema.index
+
+    def __eq__(self, other):
+        if isinstance(other, Row):
+            other = other.to_dict()
+        elif not isinstance(other, dict):
+            return NotImplemented
+        return self.to_dict() == other
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "Row({!r})".format(self.to_dict())
+
+    def to_dict(self):
+        return dict(zip(self.schema.columns, list.__iter__(self)))
+
+    def keys(self):
+        return self.schema.columns
+
+    def values(self):
+        return list(list.__iter__(self))
+
+    def items(self):
+        return list(zip(self.schema.columns, list.__iter__(self)))
+
+    def get(self, column, default=None):
+        i = self.schema.index.get(column)
+        return default if i is None else _get(self, i)
+
+    def pop(self, column, *default):
+        if column not in self.schema.index and default:
+            return default[0]
+        value = self[column]
+        del self[column]
+        return value
+
+    def setdefault(self, column, default=None):
+        if column not in self.schema.index:
+            self[column] = default
+        return self[column]
+
+    def update(self, other=(), **kwargs):
+        if isinstance(other, Row):
+            other = zip(other.schema.columns, list.__iter__(other))
+        elif hasattr(other, 'keys'):
+            other = other.items()
+        for column, value in other:
+            self[column] = value
+        for column, value in kwargs.items():
+            self[column] = value
+
+    def copy(self):
+        return Row(self.schema, list.__iter__(self))
+
+    def project(self, columns):
+        """
+        Row of only given columns
+        :type columns: list[str]
+        """
+        schema, positions = self.schema.projection(columns)
+        return Row(schema, map(_get, repeat(self), positions))
+
+
+def make_rows(records, schema=None):
+    """
+    Convert records to rows of schema. If schema is None, it's inferred from
+    columns of records, records with other columns get other schemas.
+    Otherwise records must have exactly its columns.
+    :type schema: Schema | None
+    """
+    if schema is not None:
+        for r in records:
+            yield schema.row(r)
+        return
+
+    schemas = {}
+    for r in records:
+        row = None
+        if schema is not None and len(r) == len(schema.columns):
+            try:
+                row = Row(schema, schema.values(r))
+            except KeyError:
+                pass
+        if row is None:
+            columns = tuple(r)
+            schema = schemas.get(columns)
+            if schema is None:
+                schema = schemas[columns] = Schema(columns)
+            row = Row(schema, schema.values(r))
+        yield row
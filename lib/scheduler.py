@@ -0,0 +1,108 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from lib.mr import picklable, stage_head
+
+EXECUTORS = {'process': ProcessPoolExecutor, 'thread': ThreadPoolExecutor}
+
+
+def run_stage(graphs, params, kwargs):
+    records = graphs[0](**params, **kwargs)
+    for graph in graphs[1:]:
+        records = graph(records, **kwargs)
+    return list(records)
+
+
+class Scheduler:
+    """
+    Run a plan as a DAG of stages, every stage as soon as its inputs are
+    ready, independent branches concurrently on a pool of workers.
+
+    A stage is a chain of plan nodes streaming records to each other, its
+    output is materialized and handed to consumer stages: the first
+    consumers get copies of records and the last one gets the records
+    themselves. With the process executor local nodes run in threads of the
+    driver: sources and sinks, nodes that can't be pickled and nodes running
+    their own process pools.
+    """
+    def __init__(self, plan, workers, executor='process'):
+        if executor not in EXECUTORS:
+            raise ValueError("Unknown executor: {}".format(executor))
+        self.plan = plan
+        self.workers = workers
+        self.executor = executor
+        self.stages = self.split()
+
+    def is_local(self, node):
+        head = stage_head(node.graph)
+        return self.executor == 'thread' or head.local or bool(getattr(head, 'workers', None)) \
+            or bool(getattr(head, 'partitions', None)) or not picklable(node.graph)
+
+    def split(self):
+        consumers = self.plan.consumers()
+        stages = {}
+        for node in self.plan.nodes:
+            inputs = list(node.inputs)
+            if len(inputs) == 1 and consumers[inputs[0]] == 1 and self.is_local(inputs[0]) == self.is_local(node):
+                stage = stages.pop(inputs[0])
+                stage.append(node)
+            else:
+                stage = [node]
+            stages[node] = stage
+        return list(stages.values())
+
+    def levels(self):
+        """
+        Stages grouped by length of the longest path from sources to them,
+        run time is bounded by the slowest stages of every level
+        """
+        level = {}
+        for stage in self.stages:
+            level[stage[-1]] = 1 + max((level[i] for i in stage[0].inputs), default=-1)
+        levels = [[] for _ in range(max(level.values(), default=-1) + 1)]
+        for stage in self.stages:
+            levels[level[stage[-1]]].append(stage)
+        return levels
+
+    def describe(self):
+        return "\n".join("Level {}: {}".format(i, "; ".join(
+            ", ".join(node.name for node in stage) for stage in stages)) for i, stages in enumerate(self.levels()))
+
+    def run(self, **kwargs):
+        consumers = self.plan.consumers()
+        waiting = {stage[-1]: (stage, set(stage[0].inputs)) for stage in self.stages}
+        outputs = {}
+
+        def take(node):
+            consumers[node] -= 1
+            if consumers[node]:
+                return [r.copy() for r in outputs[node]]
+            return outputs.pop(node)
+
+        local = ThreadPoolExecutor(self.workers)
+        remote = local if self.executor == 'thread' else EXECUTORS[self.executor](self.workers)
+        running = {}
+        try:
+            while waiting or running:
+                for last in [last for last, (stage, inputs) in waiting.items() if not inputs]:
+                    stage, _ = waiting.pop(last)
+                    graphs = [node.graph for node in stage]
+                    params = {k: take(v) for k, v in stage[0].params.items()}
+                    if self.is_local(stage[0]):
+                        future = local.submit(run_stage, graphs, params, kwargs)
+                    else:
+                        future = remote.submit(run_stage, graphs, params, {})
+                    running[future] = last
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    last = running.pop(future)
+                    outputs[last] = future.result()
+                    for _, inputs in waiting.values():
+                        inputs.discard(last)
+        finally:
+            for future in running:
+                future.cancel()
+            local.shutdown()
+            remote.shutdown()
+
+        return outputs.pop(self.plan.output)
@@ -0,0 +1,35 @@
+from datetime import datetime
+from functools import lru_cache
+
+CACHE_SIZE = 64 * 1024
+_FRACTION_SCALE = [10 ** (6 - i) for i in range(7)]
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def parse_timestamp(value):
+    """
+    Parse timestamp in format %Y%m%dT%H%M%S or %Y%m%dT%H%M%S.%f
+    :type value: str
+    :rtype: datetime
+    """
+    length = len(value)
+    if length < 15 or value[8] != 'T' or (length > 15 and (value[15] != '.' or length == 16 or length > 22)):
+        raise ValueError("time data {!r} does not match format '%Y%m%dT%H%M%S[.%f]'".format(value))
+
+    date, time = int(value[:8]), int(value[9:15])
+    year, month_day = divmod(date, 10000)
+    hour, minute_second = divmod(time, 10000)
+    microsecond = int(value[16:]) * _FRACTION_SCALE[length - 16] if length > 15 else 0
+    return datetime(year, month_day // 100, month_day % 100,
+                    hour, minute_second // 100, minute_second % 100, microsecond)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def format_timestamp(value):
+    """
+    Format datetime as %Y%m%dT%H%M%S.%f
+    :type value: datetime
+    :rtype: str
+    """
+    return '%04d%02d%02dT%02d%02d%02d.%06d' % (value.year, value.month, value.day,
+                                               value.hour, value.minute, value.second, value.microsecond)
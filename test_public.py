@@ -1,6 +1,16 @@
 import pytest
 import algorithms
-
+from lib import mr, operations, timestamps, aio, cluster, records
+from lib.scheduler import Scheduler
+from bench import run as run_bench
+
+import asyncio
+import json
+import os
+import pickle
+import sys
+import threading
+from datetime import datetime
 from itertools import cycle, islice
 
 
@@ -123,7 +133,8 @@ def test_pmi():
     assert etalon == result
 
 
-def test_yandex_maps():
+@pytest.mark.parametrize('batch_size', [None, 1000])
+def test_yandex_maps(batch_size):
     lengths = [
         {"start": [37.84870228730142, 55.73853974696249], "end": [37.8490418381989, 55.73832445777953],
          "edge_id": 8414926848168493057},
@@ -167,8 +178,750 @@ def test_yandex_maps():
 
     result = g.run(
         travel_times=islice(cycle(iter(times)), len(times) * 5000),
-        lengths=iter(lengths)
+        lengths=iter(lengths),
+        batch_size=batch_size
     )
 
     assert sorted(result, key=lambda x: (x['weekday'], x['hour'])) == \
            sorted(etalon, key=lambda x: (x['weekday'], x['hour']))
+
+
+def test_external_sort():
+    rows = [{'key': (i * 7919) % 1000, 'order': i} for i in range(5000)]
+
+    g = mr.FireMR().read_from_iter('rows').sort(['key'], memory_limit=16 * 1024)
+    result = g.run(rows=rows, verbose=False)
+
+    assert result == sorted(rows, key=lambda x: x['key'])
+
+
+def test_streaming_map_chain():
+    events = []
+
+    def source():
+        for i in range(3):
+            events.append(('read', i))
+            yield {'i': i}
+
+    class Log(operations.Mapper):
+        def __call__(self, r):
+            events.append(('map', r['i']))
+            yield r
+
+    g = mr.FireMR().read_from_iter('rows').map(Log()).map(operations.Dummy())
+    g.run(rows=source(), verbose=False)
+
+    assert events == [('read', 0), ('map', 0), ('read', 1), ('map', 1), ('read', 2), ('map', 2)]
+
+
+def test_fan_out_spills_tee_buffer():
+    rows = [{'key': i % 100, 'value': i} for i in range(3000)]
+
+    src = mr.FireMR().read_from_iter('rows').sort(['key'])
+    counts = src.sort(['key']).aggregate(operations.Count('count'), ['key'])
+    g = src.join(operations.InnerJoiner(), counts, ['key'])
+
+    result = g.run(rows=rows, buffer_size=100, verbose=False)
+
+    assert len(result) == len(rows)
+    assert all(r['count'] == 30 for r in result)
+    assert sorted_eq(result, [dict(r, count=30) for r in rows], ['key', 'value'])
+
+
+def test_parallel_map():
+    rows = [{'doc_id': i, 'text': 'Hello, World {}!'.format(i)} for i in range(1000)]
+    etalon = [{'doc_id': i, 'text': 'hello world {}'.format(i)} for i in range(1000)]
+
+    g = mr.FireMR().read_from_iter('rows')\
+        .map(operations.FilterPunctuation('text'), workers=2, chunk_size=100)\
+        .map(operations.LowerCase('text'), workers=2, chunk_size=64, ordered=False)
+
+    assert sorted_eq(g.run(rows=rows, verbose=False), etalon, ['doc_id'])
+
+    ordered = mr.FireMR().read_from_iter('rows')\
+        .map(operations.LowerCase('text'), workers=2, chunk_size=100)\
+        .map(operations.FilterPunctuation('text'), workers=2, chunk_size=100)
+
+    assert ordered.run(rows=rows, verbose=False) == etalon
+
+
+def test_parallel_map_unpicklable_mapper():
+    rows = [{'value': i} for i in range(100)]
+
+    g = mr.FireMR().read_from_iter('rows')\
+        .map(operations.Grep('value', lambda x: x % 2), workers=2)
+
+    assert g.run(rows=rows, verbose=False) == rows[1::2]
+
+
+def test_partitioned_reduce_and_aggregate():
+    rows = [{'doc_id': i % 7, 'text': 'word{}'.format(i % 5)} for i in range(500)]
+
+    tf = mr.FireMR().read_from_iter('rows').sort(['doc_id'])\
+        .reduce(operations.Tf('text'), ['doc_id'])
+    tf_partitioned = mr.FireMR().read_from_iter('rows')\
+        .reduce(operations.Tf('text'), ['doc_id'], partitions=3)
+
+    assert tf_partitioned.run(rows=rows, verbose=False) == tf.run(rows=rows, verbose=False)
+
+    count = mr.FireMR().read_from_iter('rows').sort(['text'])\
+        .aggregate(operations.Count('count'), ['text'])
+    count_partitioned = mr.FireMR().read_from_iter('rows')\
+        .aggregate(operations.Count('count'), ['text'], partitions=2)
+
+    assert count_partitioned.run(rows=rows, verbose=False) == count.run(rows=rows, verbose=False)
+
+
+def test_hash_aggregate():
+    rows = [{'text': t} for t in ['b', 'a', 'c', 'a', 'b', 'a']]
+
+    g = mr.FireMR().read_from_iter('rows')\
+        .aggregate(operations.Count('count'), ['text'], strategy='hash', sort_output=True)
+
+    assert g.run(rows=rows, verbose=False) == [
+        {'text': 'a', 'count': 3},
+        {'text': 'b', 'count': 2},
+        {'text': 'c', 'count': 1}
+    ]
+
+
+@pytest.mark.parametrize('strategy', ['hash', 'broadcast', 'auto'])
+@pytest.mark.parametrize('joiner', [
+    operations.InnerJoiner(), operations.OuterJoiner(), operations.LeftJoiner(), operations.RightJoiner()
+])
+def test_join_strategies(strategy, joiner):
+    first = [{'key': i % 40, 'a': i} for i in range(2000)]
+    second = [{'key': i, 'b': -i} for i in range(20, 60)]
+
+    def build(strategy):
+        left = mr.FireMR().read_from_iter('first').sort(['key'])
+        right = mr.FireMR().read_from_iter('second').sort(['key'])
+        return left.join(joiner, right, ['key'], strategy=strategy)
+
+    etalon = build('merge').run(first=first, second=second, verbose=False)
+    result = build(strategy).run(first=first, second=second, verbose=False)
+
+    assert sorted(sorted(r.items()) for r in result) == sorted(sorted(r.items()) for r in etalon)
+
+
+@pytest.mark.parametrize('joiner', [operations.InnerJoiner(), operations.OuterJoiner()])
+def test_auto_join_sorts_large_unsorted_inputs(monkeypatch, joiner):
+    monkeypatch.setattr(mr, 'HASH_JOIN_LIMIT', 4)
+    first = [{'key': i * 7919 % 5000 % 700, 'a': i} for i in range(5000)]
+    second = [{'key': i * 104729 % 5000 % 900, 'b': -i} for i in range(5000)]
+
+    def build(strategy):
+        left = mr.FireMR().read_from_iter('first')
+        right = mr.FireMR().read_from_iter('second')
+        return left.join(joiner, right, ['key'], strategy=strategy)
+
+    etalon = build('hash').run(first=first, second=second, verbose=False)
+    result = build('auto').run(first=first, second=second, verbose=False)
+    assert len(result) == len(etalon) > 0
+    assert sorted(sorted(r.items()) for r in result) == sorted(sorted(r.items()) for r in etalon)
+
+
+def test_plan_drops_satisfied_sorts(caplog):
+    rows = [{'a': i // 10, 'b': i % 10, 'c': i} for i in range(100)]
+
+    g = mr.FireMR().read_from_iter('rows')\
+        .sort(['a', 'b'])\
+        .map(operations.Grep('c', lambda x: x % 3))\
+        .sort(['a'])\
+        .map(operations.LowerCase('b'))\
+        .sort(['a', 'b'])
+
+    plan = mr.Plan(g.get_path())
+    assert [node.name for node in plan.nodes] == ['ReadIterMe', 'SortMe', 'FuseMe', 'SortMe']
+    assert plan.output.order == ('a', 'b')
+
+    with caplog.at_level('INFO'):
+        result = g.run(rows=[{'a': r['a'], 'b': str(r['b']), 'c': r['c']} for r in reversed(rows)])
+    assert 'SortMe(a) dropped' in caplog.text
+    assert [r['c'] for r in result] == [c for c in range(100) if c % 3]
+
+
+def test_plan_fuses_maps():
+    rows = [{'doc_id': i % 3, 'text': 'Hello, little World!'} for i in range(10)]
+
+    g = mr.FireMR().read_from_iter('rows')\
+        .map(operations.FilterPunctuation('text'))\
+        .map(operations.LowerCase('text'))\
+        .map(operations.Split('text'))\
+        .sort(['doc_id'])\
+        .reduce(operations.Tf('text'), ['doc_id'])\
+        .map(operations.Cut(['doc_id', 'text', 'tf']))
+
+    plan = mr.Plan(g.get_path())
+    assert [node.name for node in plan.nodes] == ['ReadIterMe', 'FuseMe', 'SortMe', 'FuseMe']
+
+    result = g.run(rows=rows, verbose=False)
+    assert result == [{'doc_id': i, 'text': t, 'tf': 1 / 3} for i in range(3) for t in ['hello', 'little', 'world']]
+
+
+def test_branches_own_their_records():
+    rows = [{'key': i, 'text': 'Hello, World'} for i in range(3000)]
+
+    src = mr.FireMR().read_from_iter('rows')
+    lower = src.map(operations.LowerCase('text'))
+    split = src.map(operations.Split('text'))\
+        .map(operations.FilterPunctuation('text'))\
+        .sort(['key'])
+    g = lower.join(operations.InnerJoiner(), split, ['key'])
+
+    result = g.run(rows=rows, buffer_size=100, verbose=False)
+
+    assert all(r == {'key': i, 'text': 'Hello, World'} for i, r in enumerate(rows))
+    assert result == [{'key': i, 'text': t} for i in range(3000) for t in ['Hello', 'World']]
+    assert src.map(operations.Dummy()).run(rows=rows, verbose=False) == rows
+
+
+def test_batch_mappers_match_rows():
+    pytest.importorskip('numpy')
+    rows = [{'a': i, 'b': i % 4 + 1, 'z': i % 4, 'c': 'x{}'.format(i)} for i in range(1, 500)]
+
+    g = mr.FireMR().read_from_iter('rows')\
+        .map(operations.Product('a', 'b', column_result='p'))\
+        .map(operations.Divide('a', 'z', column_result='d'))\
+        .map(operations.Grep('c', lambda x: not x.endswith('7')))\
+        .map(operations.Velocity('a', 'z'))\
+        .map(operations.Idf('b', 'a'))\
+        .map(operations.Cut(['a', 'b', 'p', 'd', 'speed', 'idf']))\
+        .sort(['b'])\
+        .aggregate(operations.Sum('a'), ['b'])
+
+    etalon = g.run(rows=rows, verbose=False)
+    assert g.run(rows=rows, batch_size=64, verbose=False) == etalon
+
+    plan = mr.Plan(g.get_path(), batch_size=64)
+    assert [node.name for node in plan.nodes] == ['ReadIterMe', 'BatchMe', 'CombineMe', 'SortMe', 'AggregateMe']
+
+    edge_rows = [{'a': 2 ** 40 + i, 'b': 2 ** 40, 'z': None if i % 3 else i, 'f': 0.1 * i} for i in range(100)]
+    edges = mr.FireMR().read_from_iter('rows')\
+        .map(operations.Product('a', 'b', column_result='p'))\
+        .map(operations.Divide('f', 'z', column_result='d'))\
+        .map(operations.Velocity('f', 'z'))\
+        .map(operations.Product('f', 'a', column_result='q'))\
+        .aggregate([operations.Sum('p'), operations.Sum('f'), operations.Count('count')], [])
+    etalon = edges.run(rows=edge_rows, verbose=False)
+    assert etalon[0]['p'] > 2 ** 80
+    assert edges.run(rows=edge_rows, batch_size=16, verbose=False) == etalon
+
+    divided = mr.FireMR().read_from_iter('rows').map(operations.Divide('f', 'z', column_result='d'))
+    result = divided.run(rows=edge_rows, batch_size=16, verbose=False)
+    assert result == divided.run(rows=edge_rows, verbose=False)
+    assert [r['d'] for r in result[:4]] == [None, None, None, pytest.approx(0.1)]
+
+    idf = mr.FireMR().read_from_iter('rows').map(operations.Idf('z', 'b'))
+    for batch_size in (None, 16):
+        with pytest.raises(ValueError):
+            idf.run(rows=[{'z': i % 5, 'b': 10} for i in range(20)], batch_size=batch_size, verbose=False)
+
+    # np.log(9170) differs from math.log(9170) in the last bit
+    idf_rows = [{'z': 1, 'b': 9170 + i} for i in range(20)]
+    assert idf.run(rows=idf_rows, batch_size=8, verbose=False) == idf.run(rows=idf_rows, verbose=False)
+
+    mixed = mr.FireMR().read_from_iter('rows').aggregate(operations.Sum('v'), [])
+    mixed_rows = [{'v': v} for v in [2 ** 53, 1, 1, 0.5]]
+    assert mixed.run(rows=mixed_rows, batch_size=8, verbose=False) == [{'v': 9007199254740994.0}]
+
+    left = mr.FireMR().read_from_iter('left')
+    right = mr.FireMR().read_from_iter('right')
+    for joiner in (operations.LeftJoiner(), operations.OuterJoiner()):
+        joined = left.join(joiner, right, ['k'], strategy='hash')\
+            .map(operations.Product('x', column_result='p'))\
+            .aggregate(operations.Sum('p'), ['k'], strategy='hash', sort_output=True)
+        inputs = {'left': [{'k': i, 'x': i + 1} for i in range(4)], 'right': [{'k': i, 'y': -i} for i in range(2)]}
+        assert joined.run(batch_size=8, verbose=False, **inputs) == joined.run(verbose=False, **inputs)
+
+    uneven = mr.FireMR().read_from_iter('rows').map(operations.Product('a', column_result='p'))
+    uneven_rows = [{'a': 1}, {'a': 2, 'c': 5}]
+    assert uneven.run(rows=uneven_rows, batch_size=8, verbose=False) == [{'a': 1, 'p': 1}, {'a': 2, 'c': 5, 'p': 2}]
+    summed = mr.FireMR().read_from_iter('rows').aggregate(operations.Sum('a'), [])
+    assert summed.run(rows=uneven_rows[::-1], batch_size=8, verbose=False) == [{'a': 3}]
+
+
+def test_batch_yandex_maps_operations_match_rows():
+    pytest.importorskip('numpy')
+    times = [
+        {'enter_time': '20171020T112237.427000', 'leave_time': '20171020T112238.723000', 'edge_id': 1},
+        {'enter_time': '20171022T235950.1794', 'leave_time': '20171023T020000.5', 'edge_id': 2},
+        {'enter_time': '20171011T145551', 'leave_time': '20171011T160000', 'edge_id': 3},
+        {'enter_time': '20171011T145551', 'leave_time': '20171011T145551', 'edge_id': 4},
+        {'enter_time': '20171231T225959.999999', 'leave_time': '20180101T000000.000001', 'edge_id': 5},
+    ]
+    lengths = [
+        {'start': [37.84870228730142, 55.73853974696249], 'end': [37.8490418381989, 55.73832445777953], 'edge_id': 1},
+        {'start': [37.524768467992544, 55.88785375468433], 'end': [37.52415172755718, 55.88807155843824], 'edge_id': 2},
+    ]
+
+    split = mr.FireMR().read_from_iter('times').map(operations.WeekHourSplit('enter_time', 'leave_time'))
+    assert split.run(times=times, batch_size=2, verbose=False) == split.run(times=times, verbose=False)
+
+    distance = mr.FireMR().read_from_iter('lengths').map(operations.DistanceFromLonLat('start', 'end'))
+    assert distance.run(lengths=lengths, batch_size=2, verbose=False) == \
+        [pytest.approx(r, rel=1e-12) for r in distance.run(lengths=lengths, verbose=False)]
+
+
+def test_parse_timestamp():
+    for value in ['20171020T112238.723000', '20171022T131820.842', '20171011T145551', '20171231T235959.9']:
+        template = '%Y%m%dT%H%M%S.%f' if '.' in value else '%Y%m%dT%H%M%S'
+        assert timestamps.parse_timestamp(value) == datetime.strptime(value, template)
+        assert timestamps.format_timestamp(timestamps.parse_timestamp(value)) == \
+            datetime.strptime(value, template).strftime('%Y%m%dT%H%M%S.%f')
+
+    for value in ['2017102T112238', '20171020 112238', '20171020T112238.', '20171020T112238.1234567']:
+        with pytest.raises(ValueError):
+            timestamps.parse_timestamp(value)
+
+
+def test_tokenize_matches_filter_lower_split():
+    rows = [
+        {'doc_id': 1, 'text': 'Hello, my little WORLD', 'extra': 'x'},
+        {'doc_id': 2, 'text': 'world? world... world!!! WORLD!!! HELLO!!!'},
+        {'doc_id': 3, 'text': ''},
+    ]
+
+    chain = mr.FireMR().read_from_iter('rows')\
+        .map(operations.FilterPunctuation('text'))\
+        .map(operations.LowerCase('text'))\
+        .map(operations.Split('text'))
+    tokenize = mr.FireMR().read_from_iter('rows').map(operations.Tokenize('text'))
+    light = mr.FireMR().read_from_iter('rows').map(operations.Tokenize('text', ['doc_id']))
+
+    etalon = chain.run(rows=rows, verbose=False)
+    assert tokenize.run(rows=rows, verbose=False) == etalon
+    assert light.run(rows=rows, verbose=False) == [{'doc_id': r['doc_id'], 'text': r['text']} for r in etalon]
+
+
+def test_combiner():
+    rows = [{'text': 'w{}'.format(i % 10), 'value': i} for i in range(1000)]
+
+    partials = list(mr.CombineMe(operations.Count('count'), ['text'], chunk_size=3)(rows))
+    assert len(partials) == len(rows)
+    partials = list(mr.CombineMe(operations.Count('count'), ['text'], chunk_size=10)(rows))
+    assert partials == [{'text': 'w{}'.format(i), 'count': 100} for i in range(10)]
+
+    g = mr.FireMR().read_from_iter('rows')\
+        .sort(['text'])\
+        .aggregate(operations.Sum('value'), ['text'])
+    plan = mr.Plan(g.get_path())
+    assert [node.name for node in plan.nodes] == ['ReadIterMe', 'CombineMe', 'SortMe', 'AggregateMe']
+    assert g.run(rows=rows, verbose=False) == \
+        [{'text': 'w{}'.format(i), 'value': sum(range(i, 1000, 10))} for i in range(10)]
+
+    partitioned = mr.FireMR().read_from_iter('rows')\
+        .aggregate(operations.Count('count'), ['text'], partitions=2)
+    assert partitioned.run(rows=rows, verbose=False) == [{'text': 'w{}'.format(i), 'count': 100} for i in range(10)]
+
+    rows = [{'text': 'w{}'.format(i % 10), 'value': i % 7, 'id': i} for i in range(1000)]
+    for reducer in (operations.FirstReducer(), operations.Max('value', 3)):
+        g = mr.FireMR().read_from_iter('rows').sort(['text']).reduce(reducer, ['text'])
+        plan = mr.Plan(g.get_path())
+        assert [node.name for node in plan.nodes] == ['ReadIterMe', 'CombineReduceMe', 'SortMe', 'ReduceMe']
+        etalon = [r for key in sorted(set(r['text'] for r in rows))
+                  for r in reducer([r for r in rows if r['text'] == key])]
+        assert g.run(rows=rows, verbose=False) == etalon
+
+        combined = mr.CombineReduceMe(reducer, ['text'], chunk_size=7)(rows)
+        assert list(mr.ReduceMe(reducer, ['text'])(mr.SortMe(['text'])(combined))) == etalon
+
+
+def test_top_k_and_sort_limit():
+    rows = [{'key': i % 7, 'value': (i * 37) % 11, 'order': i} for i in range(500)]
+
+    top = mr.FireMR().read_from_iter('rows').top_k('value', 4, ['key'])
+    etalon = mr.FireMR().read_from_iter('rows').sort(['key']).reduce(operations.Max('value', 4), ['key'])
+    assert top.run(rows=rows, verbose=False) == etalon.run(rows=rows, verbose=False)
+
+    limited = mr.FireMR().read_from_iter('rows').sort(['value', 'key'], limit=10)
+    assert limited.run(rows=rows, verbose=False) == sorted(rows, key=lambda x: (x['value'], x['key']))[:10]
+
+
+def test_parallel_read_from_file(tmp_path):
+    rows = [{'id': i, 'text': 'line {}'.format(i) * (i % 4)} for i in range(300)]
+    for part in range(3):
+        with open(str(tmp_path / 'part{}.txt'.format(part)), 'w') as f:
+            for r in rows[part::3]:
+                f.write(json.dumps(r) + '\n')
+    pattern = str(tmp_path / 'part*.txt')
+    etalon = rows[0::3] + rows[1::3] + rows[2::3]
+
+    serial = mr.FireMR().read_from_file(pattern, json.loads)
+    assert serial.run(verbose=False) == etalon
+
+    parallel = mr.FireMR().read_from_file(pattern, json.loads, workers=2, chunk_size=100)
+    assert parallel.run(verbose=False) == etalon
+
+    files = [str(tmp_path / 'part2.txt'), str(tmp_path / 'part0.txt')]
+    unordered = mr.FireMR().read_from_file(files, json.loads, workers=2, chunk_size=64, ordered=False)
+    assert sorted_eq(unordered.run(verbose=False), rows[2::3] + rows[0::3], ['id'])
+
+
+def test_read_from_file_encoding(tmp_path):
+    rows = [{'id': i, 'text': 'café ' * (i % 3 + 1)} for i in range(200)]
+    filename = str(tmp_path / 'latin.txt')
+    with open(filename, 'w', encoding='latin-1') as f:
+        for r in rows:
+            f.write(json.dumps(r, ensure_ascii=False) + '\n')
+
+    serial = mr.FireMR().read_from_file(filename, json.loads, encoding='latin-1')
+    assert serial.run(verbose=False) == rows
+
+    parallel = mr.FireMR().read_from_file(filename, json.loads, workers=2, chunk_size=100, encoding='latin-1')
+    assert parallel.run(verbose=False) == rows
+
+
+class CountCalls(operations.Mapper):
+    calls = 0
+
+    def __call__(self, r):
+        CountCalls.calls += 1
+        yield r
+
+
+class Exclaim(operations.Mapper):
+    def __call__(self, r):
+        yield {'text': r['text'] + '!'}
+
+
+def test_result_cache_keys_operation_code(tmp_path, monkeypatch):
+    rows = [{'text': 'word{}'.format(i)} for i in range(10)]
+    g = mr.FireMR().read_from_iter('rows').map(Exclaim()).cache(str(tmp_path))
+    assert g.run(rows=rows, verbose=False) == [{'text': r['text'] + '!'} for r in rows]
+
+    def shout(self, r):
+        yield {'text': r['text'].upper()}
+
+    monkeypatch.setattr(Exclaim, '__call__', shout)
+    assert g.run(rows=rows, verbose=False) == [{'text': r['text'].upper()} for r in rows]
+
+
+def test_result_cache(tmp_path):
+    rows = [{'doc_id': i, 'text': 'word{}'.format(i % 3)} for i in range(100)]
+    cache = mr.ResultCache(str(tmp_path / 'cache'))
+
+    g = mr.FireMR().read_from_iter('rows').map(CountCalls()).cache(cache)\
+        .aggregate(operations.Count('count'), ['text'], strategy='hash', sort_output=True)
+    etalon = [{'text': 'word{}'.format(i), 'count': 34 - (i > 0)} for i in range(3)]
+
+    CountCalls.calls = 0
+    assert g.run(rows=rows, verbose=False) == etalon
+    assert g.run(rows=rows, verbose=False) == etalon
+    assert CountCalls.calls == len(rows)
+
+    assert g.run(rows=rows[:10], verbose=False) != etalon
+    assert CountCalls.calls == len(rows) + 10
+
+    index = algorithms.build_inverted_index_graph('texts', cache=cache)
+    texts = [{'doc_id': i, 'text': 'hello little world {}'.format(i % 4)} for i in range(10)]
+    first = index.run(texts=texts, verbose=False)
+    assert index.run(texts=texts, verbose=False) == first
+    assert first == algorithms.build_inverted_index_graph('texts').run(texts=texts, verbose=False)
+
+
+def test_result_cache_evicts_least_recently_used(tmp_path):
+    cache = mr.ResultCache(str(tmp_path), max_bytes=1)
+    rows = [{'value': i} for i in range(10)]
+
+    assert list(cache.put('first', rows)) == rows
+    assert cache.get('first') is None
+
+    cache.max_bytes = 10 ** 6
+    list(cache.put('first', rows))
+    list(cache.put('second', rows[:5]))
+    for key in ('first', 'second'):
+        os.utime(cache.filename(key), (1, 1))
+    assert list(cache.get('first')) == rows
+    cache.max_bytes = os.path.getsize(cache.filename('first'))
+    cache.evict()
+    assert 'first' in cache and 'second' not in cache
+
+
+@pytest.mark.parametrize('strategy', ['sort', 'hash'])
+def test_shared_scan_aggregates(strategy):
+    rows = [{'key': i % 5, 'sub': i % 2, 'value': i} for i in range(100)]
+    etalon = [{'key': k, 'sub': s, 'total': sum(r['value'] for r in rows if (r['key'], r['sub']) == (k, s)),
+               'count': 10} for k in range(5) for s in range(2)]
+
+    src = mr.FireMR().read_from_iter('rows').sort(['key', 'sub'])
+    totals = src.aggregate(operations.Sum('value'), ['key', 'sub'], strategy=strategy).sort(['key', 'sub'])
+    counts = src.aggregate(operations.Count('count'), ['key', 'sub'], strategy=strategy).sort(['key', 'sub'])
+    g = totals.join(operations.InnerJoiner(), counts, ['key', 'sub'])\
+        .map(operations.Product('value', column_result='total'))\
+        .map(operations.Cut(['key', 'sub', 'total', 'count']))
+
+    plan = mr.Plan(g.get_path())
+    assert [node.name for node in plan.nodes] == ['ReadIterMe', 'CombineMe', 'SortMe', 'FuseMe']
+    assert isinstance(plan.output.graph.graph.aggregator, operations.MultiAggregator)
+    assert g.run(rows=rows, verbose=False) == etalon
+
+    multi = src.aggregate([operations.Sum('value'), operations.Count('count')], ['key', 'sub'], strategy=strategy)\
+        .sort(['key', 'sub'])
+    assert [{'key': r['key'], 'sub': r['sub'], 'total': r['value'], 'count': r['count']}
+            for r in multi.run(rows=rows, verbose=False)] == etalon
+
+
+def test_profile_run(tmp_path):
+    rows = [{'doc_id': i, 'text': 'hello little world {}'.format(i % 4)} for i in range(100)]
+    g = algorithms.build_word_count_graph('texts')
+
+    result, stats = g.run(texts=rows, verbose=False, profile=True)
+    assert result == g.run(texts=rows, verbose=False)
+
+    nodes = {node.name: node for node in stats.nodes}
+    assert nodes['ReadIterMe'].records_out == 100
+    assert nodes['MapMe'].records_in == 100 and nodes['MapMe'].operations == ['MapMe(Tokenize)']
+    assert nodes['SortMe'].records_out == len(result)
+    assert all(node.self_time <= node.wall_time for node in stats.nodes)
+    assert sum(node.self_time for node in stats.nodes) <= stats.wall_time
+    assert 0 < nodes['MapMe'].user_time <= nodes['MapMe'].self_time
+    assert nodes['ReadIterMe'].output_bytes > 0
+
+    data = json.loads(stats.to_json(str(tmp_path / 'stats.json')))
+    assert [node['name'] for node in data['nodes']] == [node.name for node in stats.nodes]
+    stats.to_chrome_trace(str(tmp_path / 'trace.json'))
+    with open(str(tmp_path / 'trace.json')) as f:
+        trace = json.load(f)
+    assert {e['ph'] for e in trace['traceEvents']} == {'M', 'X'}
+
+
+@pytest.mark.parametrize('name', sorted(run_bench.BENCHMARKS))
+def test_benchmark_smoke(name):
+    report = run_bench.run_benchmark(name, 200)
+    assert report['output_rows'] > 0 and report['rows_per_second'] > 0 and report['peak_rss'] > 0
+    assert report['stages'][0]['records_out'] > 0
+
+    assert run_bench.compare([report], {run_bench.report_key(report): report}) == []
+    slower = dict(report, rows_per_second=report['rows_per_second'] / 2)
+    assert len(run_bench.compare([slower], {run_bench.report_key(report): report})) == 1
+
+
+class WaitForSibling(operations.Mapper):
+    def __init__(self, barrier):
+        self.barrier = barrier
+
+    def __call__(self, r):
+        if r['value'] == 0:
+            self.barrier.wait()
+        yield r
+
+
+@pytest.mark.parametrize('executor', ['thread', 'process'])
+def test_scheduler_runs_branches_concurrently(executor):
+    # sibling branches meet at a barrier, run one after another they would break it
+    barrier = threading.Barrier(2, timeout=10)
+    src = mr.FireMR().read_from_iter('rows')
+    left = src.map(WaitForSibling(barrier))
+    right = src.map(WaitForSibling(barrier))
+    g = left.join(operations.InnerJoiner(), right, ['value'], strategy='hash')
+    assert len(g.run(rows=[{'value': i} for i in range(10)], verbose=False, workers=2, executor=executor)) == 10
+    assert not barrier.broken
+
+    texts = [{'doc_id': i, 'text': 'hello, little world {}!'.format(i % 7)} for i in range(200)]
+    index = algorithms.build_inverted_index_graph('texts')
+    assert index.run(texts=texts, verbose=False, workers=2, executor=executor) == \
+        index.run(texts=texts, verbose=False)
+
+    rows = [{'value': i} for i in range(100)]
+    src = mr.FireMR().read_from_iter('rows')
+    odd = src.map(operations.Grep('value', lambda x: x % 2))
+    buffer = []
+    g = src.join(operations.InnerJoiner(), odd, ['value'], strategy='hash').save(buffer)
+    assert g.run(rows=rows, verbose=False, workers=2, executor=executor) == []
+    assert sorted_eq(buffer, rows[1::2], ['value'])
+
+    scheduler = Scheduler(mr.Plan(g.get_path()), 2, executor)
+    sink = [[['JoinMe', 'SaveMe']]] if executor == 'thread' else [[['JoinMe']], [['SaveMe']]]
+    assert [[[node.name for node in stage] for stage in level] for level in scheduler.levels()] == \
+        [[['ReadIterMe']], [['MapMe']]] + sink
+
+
+def test_run_async():
+    rows = [{'doc_id': i, 'text': 'hello, little world {}!'.format(i % 7)} for i in range(300)]
+
+    async def produce():
+        for r in rows:
+            if r['doc_id'] % 50 == 0:
+                await asyncio.sleep(0.001)
+            yield r
+
+    async def main():
+        queue = asyncio.Queue(10)
+        g = algorithms.build_word_count_graph('texts')
+        collected = []
+
+        async def consume():
+            while True:
+                r = await queue.get()
+                if r is None:
+                    return
+                collected.append(r)
+
+        consumer = asyncio.ensure_future(consume())
+        result = await g.run_async(texts=produce(), verbose=False, queue_size=16)
+        await g.write_async(queue).run_async(texts=produce(), verbose=False, queue_size=16)
+        await queue.put(None)
+        await consumer
+
+        with pytest.raises(RuntimeError):
+            g.write_async(queue).run(texts=rows, verbose=False)
+        return result, collected
+
+    result, collected = asyncio.run(main())
+    etalon = algorithms.build_word_count_graph('texts').run(texts=rows, verbose=False)
+    assert result == etalon and collected == etalon
+
+
+def test_async_source_backpressure():
+    produced = []
+
+    async def produce():
+        for i in range(100):
+            produced.append(i)
+            yield {'value': i}
+
+    async def main():
+        source = aio.AsyncSource(produce(), asyncio.get_running_loop(), queue_size=5)
+        pump = asyncio.ensure_future(source.pump())
+        await asyncio.sleep(0.05)
+        assert len(produced) <= 6
+        records = await asyncio.get_running_loop().run_in_executor(None, list, source)
+        await pump
+        return records
+
+    assert asyncio.run(main()) == [{'value': i} for i in range(100)]
+
+
+@pytest.fixture(scope='module')
+def local_cluster():
+    processes, addresses, authkey = cluster.start_local_workers(3)
+    try:
+        with cluster.Cluster(addresses, authkey) as c:
+            yield c
+            c.shutdown()
+    finally:
+        for process in processes:
+            process.join(10)
+            if process.is_alive():
+                process.terminate()
+    assert all(process.exitcode == 0 for process in processes)
+
+
+class FailOn(operations.Mapper):
+    def __init__(self, column, value):
+        self.column = column
+        self.value = value
+
+    def __call__(self, r):
+        if r[self.column] == self.value:
+            raise ValueError("Bad value: {}".format(r[self.column]))
+        yield r
+
+
+def test_cluster_runs_reference_algorithms(local_cluster):
+    texts = [{'doc_id': i, 'text': 'Hello, little world{}! hello {}'.format(i % 11, i % 5)} for i in range(300)]
+    for build in (algorithms.build_word_count_graph, algorithms.build_pmi_graph):
+        g = build('texts')
+        assert g.run(texts=texts, verbose=False, cluster=local_cluster) == g.run(texts=texts, verbose=False)
+
+    # tied documents don't keep their order on cluster, so top 3 are the same
+    # words with the same scores, but the documents of tied scores may differ
+    g = algorithms.build_inverted_index_graph('texts')
+    local = g.run(texts=texts, verbose=False)
+    remote = g.run(texts=texts, verbose=False, cluster=local_cluster)
+    assert [(r['text'], r['tf_idf']) for r in remote] == [(r['text'], pytest.approx(r['tf_idf'])) for r in local]
+    tf_idf = mr.FireMR(g.tail.params['records'].params['records'])
+    assert isinstance(tf_idf.tail.graph.mapper, operations.Product)
+    scores = {(r['text'], r['doc_id']): r['tf_idf'] for r in tf_idf.run(texts=texts, verbose=False)}
+    assert [r['tf_idf'] for r in remote] == [pytest.approx(scores[r['text'], r['doc_id']]) for r in remote]
+
+    g = algorithms.build_yandex_maps_graph('times', 'lengths')
+    times = [{'enter_time': '201710{:02d}T{:02d}0000.000000'.format(9 + i % 7, i % 24),
+              'leave_time': '201710{:02d}T{:02d}0010.500000'.format(9 + i % 7, i % 24), 'edge_id': i % 5}
+             for i in range(500)]
+    lengths = [{'start': [37.84 + i / 100, 55.73], 'end': [37.85, 55.74 + i / 100], 'edge_id': i} for i in range(5)]
+    assert g.run(times=times, lengths=lengths, verbose=False, cluster=local_cluster) == \
+        [pytest.approx(r) for r in g.run(times=times, lengths=lengths, verbose=False)]
+
+
+def test_cluster_shuffles_by_keys(local_cluster):
+    g = algorithms.build_word_count_graph('texts')
+    plan = mr.Plan(g.get_path())
+    partitioning, shuffles = local_cluster.partitioning(plan)
+    assert list(shuffles.values()) == [('text',)]
+    assert partitioning[plan.output] == ('text',)
+
+    rows = [{'value': i} for i in range(10)]
+    failing = mr.FireMR().read_from_iter('rows').map(FailOn('value', 0))
+    with pytest.raises(RuntimeError, match='Bad value: 0'):
+        failing.run(rows=rows, verbose=False, cluster=local_cluster)
+    assert failing.run(rows=rows[1:], verbose=False, cluster=local_cluster) == \
+        failing.run(rows=rows[1:], verbose=False)
+
+
+def test_cluster_partitions_equal_keys_together(local_cluster):
+    assert len({cluster.partition_of((value, 'a'), 7) for value in (1, 1.0, True)}) == 1
+
+    ints = [{'key': i % 10, 'left': i} for i in range(50)]
+    floats = [{'key': float(i), 'right': i} for i in range(10)]
+    g = mr.FireMR().read_from_iter('ints')\
+        .join(operations.InnerJoiner(), mr.FireMR().read_from_iter('floats'), ['key'], strategy='hash')
+    etalon = g.run(ints=ints, floats=floats, verbose=False)
+    assert len(etalon) == 50
+    assert sorted_eq(g.run(ints=ints, floats=floats, verbose=False, cluster=local_cluster), etalon, ['left'])
+
+
+def test_partitioned_fused_stage_runs_locally(local_cluster):
+    rows = [{'doc_id': i % 7, 'text': 'word{}'.format(i % 5)} for i in range(100)]
+    g = mr.FireMR().read_from_iter('rows').sort(['doc_id'])\
+        .reduce(operations.Tf('text'), ['doc_id'], partitions=2).map(operations.Dummy())
+    plan = mr.Plan(g.get_path())
+    assert isinstance(plan.output.graph, mr.FuseMe)
+    assert Scheduler(plan, 2, 'process').is_local(plan.output)
+    assert local_cluster.is_local(plan.output)
+    assert g.run(rows=rows, verbose=False, workers=2, executor='process') == g.run(rows=rows, verbose=False)
+    assert g.run(rows=rows, verbose=False, cluster=local_cluster) == g.run(rows=rows, verbose=False)
+
+
+def test_schema_rows():
+    schema = records.Schema(['doc_id', 'text'])
+    r = schema.row({'text': 'a b', 'doc_id': 1})
+    assert r == {'doc_id': 1, 'text': 'a b'} and dict(r) == {'doc_id': 1, 'text': 'a b'}
+    assert sys.getsizeof(r) < sys.getsizeof({'doc_id': 1, 'text': 'a b'}) / 2
+
+    r['count'] = 2
+    del r['text']
+    assert r == {'doc_id': 1, 'count': 2} and r.schema is schema.extended('count').without('text')
+    assert pickle.loads(pickle.dumps(r)) == r
+    assert operations.Cut(['count'])(r).__next__().schema.columns == ('count',)
+    with pytest.raises(ValueError):
+        schema.row({'doc_id': 1, 'title': 'a b'})
+
+    sort = mr.SortMe(['text', 'doc_id'])
+    assert pickle.loads(pickle.dumps(sort)).get_key({'doc_id': 1, 'text': 'a'}) == ('a', 1)
+
+    texts = [{'doc_id': i, 'text': 'Hello, little world{}! hello {}'.format(i % 11, i % 5)} for i in range(300)]
+    for build in (algorithms.build_word_count_graph, algorithms.build_inverted_index_graph,
+                  algorithms.build_pmi_graph):
+        assert build('texts', schema=True).run(texts=texts, verbose=False) == \
+            build('texts').run(texts=texts, verbose=False)
+    assert texts[0] == {'doc_id': 0, 'text': 'Hello, little world0! hello 0'}
+
+
+def test_compiled_plan():
+    g = algorithms.build_word_count_graph('docs')
+    compiled = g.compile()
+    assert g.compile() is compiled and g.compile(batch_size=64) is not compiled
+    with pytest.raises(AttributeError):
+        compiled.steps = ()
+
+    for i in range(10):
+        docs = [{'doc_id': j, 'text': 'hello world{}'.format(j % 3)} for j in range(i)]
+        assert compiled.execute(docs=docs) == g.run(docs=docs, verbose=False)
+    assert g.compile() is compiled
+
+    longer = g.map(operations.Dummy())
+    assert longer.tail.previous is g.tail and longer.compile() is not compiled
+    with pytest.raises(ValueError):
+        mr.FireMR().map(operations.Dummy())